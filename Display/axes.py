@@ -38,6 +38,8 @@ class Ax:
         Sets the x- and y-labels of the ax object.
     update_kwargs(**kwargs)
         Updates the keyword arguments for the ax object.
+    plot_preview(datafile, index, max_pixels:int=512**2, **kwargs)
+        Plots a downsampled channel from the preview pyramid of a GwyFile.
     plot_cAFM(datafile, key:str="CR", **kwargs)
         Plots a cAFM scan.
     plot_inset(datafile, key:str="CR", **inset_kwargs)
@@ -120,7 +122,11 @@ class Ax:
                 "quantile": 0.5,
                 "colorbar": True,
                 "scalebar": True,
+                "stats": None,
                 }
+
+            stats is a dict with the hist, hist_edges and mean of the data, e.g. GwyFile.get_stats(index). 
+            If given, normal and binomial use it instead of computing the histogram of the data.
         """
         std_kwargs = {
             "cmap": "magma", 
@@ -132,6 +138,7 @@ class Ax:
             "quantile": 0.5,
             "colorbar": True,
             "scalebar": True, #TODO: Fix this.
+            "stats": None,
         }
 
         for key, value in kwargs.items():
@@ -151,9 +158,14 @@ class Ax:
 
         if not(std_kwargs["raw"]) and std_kwargs["vmin"] is None and std_kwargs["vmax"] is None:
 
+            if std_kwargs["normal"] or std_kwargs["binomial"]:
+                if std_kwargs["stats"] is not None:
+                    hist, edges, mean = np.asarray(std_kwargs["stats"]["hist"]), np.asarray(std_kwargs["stats"]["hist_edges"]), std_kwargs["stats"]["mean"]
+                else:
+                    hist, edges = np.histogram(data, bins=100)
+                    mean = np.mean(data)
+
             if std_kwargs["normal"]:
-                
-                hist, edges = np.histogram(data, bins=100)
 
                 pvalue = np.max(hist)
                 peak = edges[np.argmax(hist)]
@@ -169,12 +181,10 @@ class Ax:
 
             elif std_kwargs["binomial"]:
 
-                hist, edges = np.histogram(data, bins=100)
-
-                low_edges = edges[np.where(edges < np.mean(data))]
-                high_edges = edges[np.where(edges > np.mean(data))]
-                below_mean = hist[np.where(edges < np.mean(data))]
-                above_mean = hist[np.where(edges > np.mean(data))]
+                low_edges = edges[:-1][np.where(edges[:-1] < mean)]
+                high_edges = edges[:-1][np.where(edges[:-1] > mean)]
+                below_mean = hist[np.where(edges[:-1] < mean)]
+                above_mean = hist[np.where(edges[:-1] > mean)]
 
                 minvalue = low_edges[np.argmax(below_mean)]
                 maxvalue = high_edges[np.argmax(above_mean)]
@@ -185,6 +195,9 @@ class Ax:
                 print(minvalue, maxvalue)
 
                 #Something like this. Does not fully function. 
+            elif std_kwargs["stats"] is not None:
+                std_kwargs["vmin"] = std_kwargs["stats"]["min"]
+                std_kwargs["vmax"] = std_kwargs["stats"]["max"]
             else:
                 # Some bullshit but fast way
                 std_kwargs["vmin"] = np.min(data)
@@ -206,6 +219,27 @@ class Ax:
 
         return
 
+    def plot_preview(self, datafile, index, max_pixels: int = 512**2, **kwargs):
+        """
+        Plots a downsampled channel, read from the preview pyramid of the hdf5 file instead of the full resolution data.
+
+        Parameters
+        ----------
+        datafile : GwyFile
+            The container of the data to plot.
+        index : str/int
+            The original index of the channel.
+        max_pixels : int, optional
+            The target number of pixels. The default is 512**2.
+        **kwargs : dict, optional
+            The keyword arguments for plot_standard. The stored statistics of the channel are used for the contrast by default.
+        """
+        data, factor = datafile.get_preview(index, max_pixels=max_pixels)
+        xres = datafile.index_metadata(index, "xres")*factor
+        kwargs.setdefault("stats", datafile.get_stats(index))
+        self.plot_standard(data, xres, **kwargs)
+        return
+
     
     def plot_cAFM(self, datafile, key:str="CR", **kwargs): #TODO: Fix imports
         """
@@ -11,13 +11,13 @@ import attributes as attr
 import math
 
 
-def plot_overview(gwyfile, size=10):
+def plot_overview(gwyfile, size=10, max_pixels=256**2):
     cal_size = len(gwyfile.channel_names)
     cal_grid = math.ceil(math.sqrt(cal_size))
     fig, axs = plt.subplots(cal_grid, cal_grid, figsize=(size, size))
-    for i, (name,ax) in enumerate(zip(gwyfile.channel_names, axs.flatten())):
+    for i, (name,ax) in enumerate(zip(gwyfile.channel_names, np.atleast_1d(axs).flatten())):
         map = "gray" if "Height" in name else "magma"
-        ax.imshow(gwyfile[i], cmap=map)
+        ax.imshow(gwyfile.get_preview(i, max_pixels=max_pixels, name=False)[0], cmap=map)
         ax.set_title(name)
     plt.show()
     return
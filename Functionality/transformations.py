@@ -1,6 +1,10 @@
 
 import numpy as np
 import scipy as sp
+import scipy.ndimage as ndi
+from numpy.polynomial import legendre
+from functools import lru_cache
+import warnings
 
 def plane_level(height: np.array):
     """
@@ -38,7 +42,6 @@ def plane_level(height: np.array):
 # https://math.stackexchange.com/questions/1234240/equation-that-defines-multi-dimensional-polynomial
 
 # TODO: This one: https://stackoverflow.com/questions/33964913/equivalent-of-polyfit-for-a-2d-polynomial-in-python 
-#TODO: Does not work for rectangular areas. Must be something wrong.
 
 def plane_level_heavyside(height:np.array, xmin:int, xmax:int):
     #TODO: Make more universal. Enable ymin and ymax as well. And default max or min to 0, shape, resp. 
@@ -79,60 +82,307 @@ def plane_level_heavyside(height:np.array, xmin:int, xmax:int):
 
     return Z, C
 
-def poly2D_least_squares(height: np.array, order: int, xmin:int=None, xmax:int=None, ymin=None, ymax=None):
+class PolyBackground:
     """
-    Employs a least squares fit to find the polynomial of a set of points.
+    Least squares fit of a 2D polynomial background of total degree order, i.e. the terms x**j * y**i with i + j <= order.
+
+    The polynomial is expressed in Legendre polynomials of the coordinates normalized to [-1, 1] over the image, 
+    which keeps the normal equations well conditioned at high orders. Since the basis is separable, P_j(x)*P_i(y), 
+    neither the design matrix nor the basis images are ever formed:
+        the normal matrix is G[(i,j),(k,l)] = Gy[i,k]*Gx[j,l], with Gy = Py.T @ Py and Gx = Px.T @ Px of the 1D bases in the ROI,
+        the right hand side is (Py.T @ data @ Px)[i,j],
+        and the surface is evaluated as Py @ C @ Px.T.
+    Memory is therefore O(H*W) and the cost is a few matrix products, nearly independent of the order. 
+    The factorization only depends on the shape, order and ROI, so one instance can level any number of images.
+
+    Attributes
+    ----------
+    shape : tuple
+        The shape (H, W) of the images.
+    order : int
+        The total degree of the polynomial.
+    xmin, xmax, ymin, ymax : int
+        The ROI, x along columns and y along rows. The default is the full image.
+
+    Methods
+    -------
+    coefficients(data)
+        Returns the Legendre coefficients of the fit to one image (H, W) or a stack (N, H, W).
+    weighted_coefficients(data, weights)
+        Returns the Legendre coefficients of the weighted fit to one image, e.g. with a boolean mask as weights.
+    evaluate(c)
+        Returns the background surface(s) of the coefficients.
+    __call__(data)
+        Returns the fitted background surface(s).
+    """
+
+    def __init__(self, shape: tuple, order: int, xmin: int = None, xmax: int = None, ymin: int = None, ymax: int = None):
+        self.shape = tuple(shape[-2:])
+        self.order = order
+
+        height, width = self.shape
+        self.xmin, self.xmax = 0 if xmin is None else xmin, width if xmax is None else xmax
+        self.ymin, self.ymax = 0 if ymin is None else ymin, height if ymax is None else ymax
+
+        self.Px = legendre.legvander(self.normalized(width), order)
+        self.Py = legendre.legvander(self.normalized(height), order)
+        self.Px_roi = self.Px[self.xmin:self.xmax]
+        self.Py_roi = self.Py[self.ymin:self.ymax]
+
+        # Index pairs (y degree, x degree) of the terms with total degree <= order.
+        self.terms = np.array([(i, j) for i in range(order+1) for j in range(order-i+1)])
+        self.I, self.J = self.terms[:, 0], self.terms[:, 1]
+
+        Gx = self.Px_roi.T @ self.Px_roi
+        Gy = self.Py_roi.T @ self.Py_roi
+        G = Gy[np.ix_(self.I, self.I)] * Gx[np.ix_(self.J, self.J)]
+        self.G_inv = np.linalg.pinv(G, hermitian=True)
+        self.pairs = None
+        return
+
+    @staticmethod
+    def normalized(n: int) -> np.ndarray:
+        """
+        Returns n pixel coordinates mapped to [-1, 1].
+        """
+        return np.linspace(-1, 1, n) if n > 1 else np.zeros(n)
+
+    def coefficients(self, data: np.ndarray) -> np.ndarray:
+        """
+        Returns the Legendre coefficients, ordered as self.terms, of the fit to one image (H, W) or a stack (N, H, W).
+        """
+        roi = np.asarray(data)[..., self.ymin:self.ymax, self.xmin:self.xmax]
+        moments = self.Py_roi.T @ roi @ self.Px_roi
+        return moments[..., self.I, self.J] @ self.G_inv
+
+    def weighted_coefficients(self, data: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Returns the Legendre coefficients, ordered as self.terms, of the weighted fit to one image (H, W).
+        The weighted normal matrix G[(i,j),(k,l)] = sum w * Py_i*Py_k * Px_j*Px_l is accumulated from the products of pairs of 1D basis functions, 
+        (Qy.T @ w @ Qx), which are computed once per instance and reused for every set of weights.
+
+        Parameters
+        ----------
+        data : np.array
+            The image.
+        weights : np.array
+            Non-negative weights of the pixels, e.g. a boolean mask.
+        """
+        if self.pairs is None:
+            n = self.order + 1
+            self.pairs = ((self.Py_roi[:, :, None]*self.Py_roi[:, None, :]).reshape(-1, n*n),
+                          (self.Px_roi[:, :, None]*self.Px_roi[:, None, :]).reshape(-1, n*n))
+        Qy, Qx = self.pairs
+        n = self.order + 1
+
+        roi = (slice(self.ymin, self.ymax), slice(self.xmin, self.xmax))
+        w = np.asarray(weights, dtype=float)[roi]
+        M = (Qy.T @ w @ Qx).reshape(n, n, n, n)
+        G = M[self.I[:, None], self.I[None, :], self.J[:, None], self.J[None, :]]
+        b = (self.Py_roi.T @ (w*np.asarray(data)[roi]) @ self.Px_roi)[self.I, self.J]
+        return np.linalg.lstsq(G, b, rcond=None)[0]
+
+    def evaluate(self, c: np.ndarray) -> np.ndarray:
+        """
+        Returns the background surface (H, W), or surfaces (N, H, W), of the coefficients.
+        """
+        C = np.zeros(np.shape(c)[:-1] + (self.order+1, self.order+1))
+        C[..., self.I, self.J] = c
+        return self.Py @ C @ self.Px.T
+
+    def __call__(self, data: np.ndarray) -> np.ndarray:
+        return self.evaluate(self.coefficients(data))
+
+
+@lru_cache(maxsize=32)
+def poly_background(shape: tuple, order: int, xmin: int = None, xmax: int = None, ymin: int = None, ymax: int = None) -> PolyBackground:
+    """
+    Returns the cached PolyBackground of a shape, order and ROI, so the factorization is built once per combination.
+    """
+    return PolyBackground(shape, order, xmin, xmax, ymin, ymax)
+
+
+def polygon_mask(shape: tuple, pts: np.ndarray) -> np.ndarray:
+    """
+    Rasterizes a polygon to a boolean mask with a scanline fill (even-odd rule), without OpenCV.
+    A pixel is inside if its center is inside the polygon. The crossings of all edges with all rows are computed at once.
+    Not identical to cv2.fillPoly (used in calc_grain_size), which also fills the pixels the outline passes through,
+    so the masks differ along the boundary of the polygon.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape (H, W) of the mask.
+    pts : np.array
+        The corners of the polygon as (x, y) points, shape (N, 2) or the OpenCV contour shape (N, 1, 2).
+
+    Returns
+    -------
+    mask : np.array
+    """
+    height, width = shape[-2:]
+    pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+    x0, y0 = pts[:, 0], pts[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    rows = np.arange(height)[:, None]
+    active = (np.minimum(y0, y1) <= rows) & (rows < np.maximum(y0, y1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossings = x0 + (rows - y0)*(x1 - x0)/(y1 - y0)
+
+    # Each crossing toggles inside/outside from the first pixel center at or right of it.
+    r, e = np.nonzero(active)
+    columns = np.clip(np.ceil(crossings[r, e]), 0, width).astype(int)
+    toggles = np.zeros((height, width + 1), dtype=int)
+    np.add.at(toggles, (r, columns), 1)
+    return (np.cumsum(toggles, axis=1)[:, :width] % 2) == 1
+
+
+def robust_weights(u: np.ndarray, method: str = "tukey") -> np.ndarray:
+    """
+    Returns the IRLS weights of scaled residuals u = r/(c*sigma).
+    Huber: min(1, 1/|u|). Tukey (biweight): (1 - u**2)**2 for |u| < 1, else 0.
+    """
+    u = np.abs(u)
+    if method == "huber":
+        return np.minimum(1, 1/np.maximum(u, 1e-12))
+    elif method == "tukey":
+        return np.where(u < 1, (1 - u**2)**2, 0)
+    raise ValueError(f"Unknown method {method}. Use huber or tukey.")
+
+
+def robust_level(height: np.array, order: int = 1, mask: np.array = None, polygon: np.array = None, method: str = "tukey", c: float = None, max_iter: int = 30, tol: float = 1e-6):
+    """
+    Fits a polynomial background to the pixels in a mask and/or polygon, 
+    with iteratively reweighted least squares (IRLS) that suppresses domain walls, particles and other outliers.
+    The residual scale is estimated with the median absolute deviation in every iteration. 
+    The basis matrices of the fit are built once (see poly_background and PolyBackground.weighted_coefficients) and reused between iterations.
 
     Parameters
     ----------
     height : np.array
         The height map.
-    order : int
-        The order of the polynomial.
+    order : int, optional
+        The order of the polynomial. The default is 1 (plane).
+    mask : np.array, optional
+        Boolean mask of the pixels to fit. The default is None (all pixels).
+    polygon : np.array, optional
+        Corners (x, y) of a polygon of the pixels to fit, see polygon_mask. Combined with mask if both are given. The default is None.
+    method : str, optional
+        "huber", "tukey", or None for a single masked least squares fit. The default is "tukey".
+    c : float, optional
+        The tuning constant in units of the residual scale. The default is 1.345 for Huber and 4.685 for Tukey (95 % efficiency).
+    max_iter : int, optional
+        The maximum number of reweighting iterations. The default is 30.
+    tol : float, optional
+        The relative change of the coefficients at convergence. The default is 1e-6.
 
     Returns
     -------
     Z : np.array
-        The polynomial.
-    C : np.array
-        The coefficients of the polynomial.
+        The polynomial background.
+    """
+    height = np.asarray(height, dtype=float)
+    model = poly_background(height.shape, order)
+
+    base = np.ones(height.shape)
+    if mask is not None:
+        base = base*mask
+    if polygon is not None:
+        base = base*polygon_mask(height.shape, polygon)
+    assert base.any(), "The mask/polygon contains no pixels."
+
+    coefficients = model.weighted_coefficients(height, base)
+    if method is None:
+        return model.evaluate(coefficients)
+
+    c = {"huber": 1.345, "tukey": 4.685}[method] if c is None else c
+    inside = base > 0
+    for _ in range(max_iter):
+        residuals = height - model.evaluate(coefficients)
+        scale = 1.4826*np.median(np.abs(residuals[inside] - np.median(residuals[inside])))
+        if scale == 0:
+            break
+
+        new = model.weighted_coefficients(height, base*robust_weights(residuals/(c*scale), method))
+        converged = np.max(np.abs(new - coefficients)) <= tol*max(np.max(np.abs(coefficients)), 1e-300)
+        coefficients = new
+        if converged:
+            break
+
+    return model.evaluate(coefficients)
+
+
+def batch_level(data, order: int = 1, xmin: int = None, xmax: int = None, ymin: int = None, ymax: int = None, force: bool = False):
     """
+    Subtracts a polynomial background (see PolyBackground) from every image of a stack, or every channel of a GwyFile.
+    One factorization is reused for all images of the same shape and ROI, and all of them are fitted and evaluated in batched matrix products.
 
-    def find_lims(xmin, xmax, ymin, ymax, height):
-        if xmin is None:
-            xmin = 0
-        if xmax is None:
-            xmax = height.shape[0]
-        if ymin is None:
-            ymin = 0
-        if ymax is None:
-            ymax = height.shape[1]
-        return xmin, xmax, ymin, ymax
-    
-    def get_basis(x, y, order):
-        basis = []
-        for i in range(order+1):
-            for j in range(order-i+1):
-                basis.append(x**j * y**i)
-        return basis
+    For a GwyFile, the channels are grouped by shape and the leveled channels are written with save_processed as operation "poly_level", 
+    with the order and ROI as parameters. Channels already leveled with the same parameters are read instead of recomputed, unless force is True.
 
+    Parameters
+    ----------
+    data : np.array or GwyFile
+        A stack (N, H, W), a single image (H, W), or a GwyFile.
+    order : int, optional
+        The order of the polynomial. The default is 1 (plane).
+    xmin, xmax, ymin, ymax : int, optional
+        The ROI, x along columns and y along rows. The default is the full image.
+    force : bool, optional
+        Whether to recompute channels of a GwyFile that are already leveled. The default is False.
 
-    xmin, xmax, ymin, ymax = find_lims(xmin, xmax, ymin, ymax, height)
-    x, y = np.arange(xmin, xmax), np.arange(ymin, ymax)
-    XROI, YROI = np.meshgrid(x, y)
-    basis = get_basis(XROI.ravel(), YROI.ravel(), order)
+    Returns
+    -------
+    leveled : np.array or dict
+        The leveled stack/image, or a dict of channel name to leveled channel for a GwyFile.
+    """
+    roi = (xmin, xmax, ymin, ymax)
 
-    A = np.vstack(basis).T
-    b = height[xmin:xmax, ymin:ymax].ravel()
+    if not hasattr(data, "channel_names"):
+        data = np.asarray(data, dtype=float)
+        return data - poly_background(data.shape[-2:], order, *roi)(data)
 
-    # C, r, rank, s = sp.linalg.lstsq(A, b)
-    c, _, _, _ = np.linalg.lstsq(A, b, rcond=None) #TODO: Find the best one
+    gwyfile = data
+    params = {"order": order, "xmin": xmin, "xmax": xmax, "ymin": ymin, "ymax": ymax}
+    leveled = {}
+    shapes = {}
+    for n, channel in enumerate(gwyfile.channel_names):
+        if not force and gwyfile.has_processed(n, "poly_level", params, name=False):
+            leveled[channel] = gwyfile.get_processed(n, "poly_level", params, name=False)
+        else:
+            shapes.setdefault(gwyfile.get_lazy(n, name=False).shape, []).append(n)
 
-    X, Y = np.meshgrid(np.arange(height.shape[0]), np.arange(height.shape[1]))
-    Z = np.sum(c[:, None, None] * np.array(get_basis(X, Y, order))
-                .reshape(len(basis), *X.shape), axis=0)
-    
-    return Z#, c #TODO: Should 2th degree polynomial also be retrieved from same area?
+    for shape, indices in shapes.items():
+        stack = np.stack([gwyfile.get_nth(n) for n in indices]).astype(float)
+        stack -= poly_background(shape, order, *roi)(stack)
+        for n, image in zip(indices, stack):
+            gwyfile.save_processed(n, image, name=False, operation="poly_level", params=params, mode="overwrite")
+            leveled[gwyfile.channel_names[n]] = image
+
+    return {channel: leveled[channel] for channel in gwyfile.channel_names}
+
+
+def poly2D_least_squares(height: np.array, order: int, xmin:int=None, xmax:int=None, ymin=None, ymax=None):
+    """
+    Employs a least squares fit to find the polynomial of a set of points.
+    The fit is restricted to the ROI xmin:xmax (columns) and ymin:ymax (rows), and evaluated on the whole image. See PolyBackground.
+
+    Parameters
+    ----------
+    height : np.array
+        The height map.
+    order : int
+        The order of the polynomial.
+    xmin, xmax, ymin, ymax : int, optional
+        The ROI. The default is the full image.
+
+    Returns
+    -------
+    Z : np.array
+        The polynomial.
+    """
+    return poly_background(height.shape, order, xmin, xmax, ymin, ymax)(height) #TODO: Should 2th degree polynomial also be retrieved from same area?
 
 def poly2D_3point_level(height: np.array, order: int, xpoints: list, ypoints:list):
     #TODO: Consider: Needs N points for degree N. 
@@ -185,17 +435,213 @@ def poly2D_3point_level(height: np.array, order: int, xpoints: list, ypoints:lis
                 .reshape(len(basis), *X.shape), axis=0)
     return Z
 
-def scar_line_detection(data:np.array, rot:float=0, scan_axis:int=0, threshold:float=None, line_width:int=1):
-    return
+def to_scan_frame(data: np.array, rot: float = 0, scan_axis: int = 0) -> np.array:
+    """
+    Transposes and rotates data so that the scan lines are the rows. 
+    Multiples of 90 degrees are exact, other angles are interpolated with the uncovered corners set to NaN.
+    """
+    data = np.asarray(data, dtype=float)
+    data = data.T if scan_axis == 1 else data
+    if rot % 90 == 0:
+        return np.rot90(data, int(rot//90) % 4)
+    return ndi.rotate(data, rot, reshape=True, order=1, mode="constant", cval=np.nan)
 
-def median_conv_scan_line_removal(data:np.array, rotation:float=0, threshold:float=None, line_width:int=1):
-    #TODO: Implement horizontal and/or vertical lines.
-    return
+def from_scan_frame(data: np.array, shape: tuple, rot: float = 0, scan_axis: int = 0, order: int = 1) -> np.array:
+    """
+    Inverse of to_scan_frame, cropped to the original shape.
+    """
+    if rot % 90 == 0:
+        data = np.rot90(data, -int(rot//90) % 4)
+    else:
+        data = ndi.rotate(data, -rot, reshape=True, order=order, mode="constant", cval=np.nan)
+        height, width = shape[::-1] if scan_axis == 1 else shape
+        top, left = (data.shape[0] - height)//2, (data.shape[1] - width)//2
+        data = data[top:top+height, left:left+width]
+    return data.T if scan_axis == 1 else data
+
+def scar_line_detection(data:np.array, rot:float=0, scan_axis:int=0, threshold:float=None, line_width:int=1, min_length:int=16):
+    """
+    Detects scars: segments of 1 to line_width adjacent scan lines, at least min_length pixels long along the scan lines, 
+    that are all higher, or all lower, than the scan lines on both sides by more than threshold times the noise level.
+    Shorter runs, e.g. single noisy pixels, are removed with a binary opening along the scan lines, like the minimum length in Gwyddion's Mark Scars.
+    The noise level is estimated robustly from the differences between adjacent scan lines (MAD), so domains and tilt do not affect it.
+    Every segment width is tested on all pixels at once with sliding minima/maxima across the scan lines.
+
+    Parameters
+    ----------
+    data : np.array
+        The image.
+    rot : float, optional
+        The angle in degrees to rotate the image by so the scan lines are horizontal. The default is 0.
+    scan_axis : int, optional
+        0 if the scan lines are rows, 1 if they are columns. The default is 0.
+    threshold : float, optional
+        The minimum step to both neighbouring scan lines, in units of the noise level. The default is None, which is 3.
+    line_width : int, optional
+        The maximum width of a scar in scan lines. The default is 1.
+    min_length : int, optional
+        The minimum length of a scar along the scan lines, in pixels. The default is 16.
+
+    Returns
+    -------
+    mask : np.array
+        Boolean mask of the scar pixels, in the frame of data.
+    """
+    threshold = 3 if threshold is None else threshold
+    frame = to_scan_frame(data, rot, scan_axis)
+    height = frame.shape[0]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        differences = np.diff(frame, axis=0)
+        sigma = 1.4826*np.nanmedian(np.abs(differences - np.nanmedian(differences)))/np.sqrt(2)
+    limit = threshold*sigma
+
+    mask = np.zeros(frame.shape, dtype=bool)
+    for width in range(1, min(line_width, height - 2) + 1):
+        windows = np.lib.stride_tricks.sliding_window_view(frame, width, axis=0)[1:height-width]
+        above, below = frame[:height-width-1], frame[width+1:]
+        # Segments starting at row r (r = 1 ... height-width-1), compared with rows r-1 and r+width.
+        hits = (windows.min(axis=-1) - np.fmax(above, below) > limit) | (windows.max(axis=-1) - np.fmin(above, below) < -limit)
+        if min_length > 1:
+            hits = ndi.binary_opening(hits, structure=np.ones((1, min_length), dtype=bool))
+        for t in range(width):
+            mask[1+t:height-width+t] |= hits
+
+    if rot % 90 == 0:
+        return from_scan_frame(mask, np.shape(data), rot, scan_axis)
+    return from_scan_frame(mask.astype(float), np.shape(data), rot, scan_axis, order=0) > 0.5
+
+def median_conv_scan_line_removal(data:np.array, rotation:float=0, threshold:float=None, line_width:int=1, scan_axis:int=0, min_length:int=16):
+    """
+    Removes scars detected with scar_line_detection, by linear interpolation across the scan lines 
+    between the nearest unmarked pixels above and below each scar pixel. Pixels outside scars are unchanged.
+
+    Parameters
+    ----------
+    data : np.array
+        The image.
+    rotation : float, optional
+        The angle in degrees to rotate the image by so the scan lines are horizontal. The default is 0.
+    threshold : float, optional
+        The minimum step to both neighbouring scan lines, in units of the noise level. The default is None, which is 3.
+    line_width : int, optional
+        The maximum width of a scar in scan lines. The default is 1.
+    scan_axis : int, optional
+        0 if the scan lines are rows, 1 if they are columns. The default is 0.
+    min_length : int, optional
+        The minimum length of a scar along the scan lines, in pixels. The default is 16.
+
+    Returns
+    -------
+    repaired : np.array
+        The image with the scars replaced.
+    mask : np.array
+        Boolean mask of the replaced pixels.
+    """
+    data = np.asarray(data, dtype=float)
+    mask = scar_line_detection(data, rotation, scan_axis, threshold, line_width, min_length)
+    frame = to_scan_frame(data, rotation, scan_axis)
+    frame_mask = to_scan_frame(mask, rotation, scan_axis) > 0.5
+
+    # Nearest valid scan line above and below every pixel, from running maxima/minima of the valid row indices.
+    valid = ~frame_mask & np.isfinite(frame)
+    rows = np.broadcast_to(np.arange(frame.shape[0])[:, None], frame.shape)
+    previous = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, rows, frame.shape[0])[::-1], axis=0)[::-1]
+
+    has_previous, has_following = previous >= 0, following < frame.shape[0]
+    previous_value = np.take_along_axis(frame, np.clip(previous, 0, frame.shape[0]-1), axis=0)
+    following_value = np.take_along_axis(frame, np.clip(following, 0, frame.shape[0]-1), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fraction = np.where(has_previous & has_following, (rows - previous)/(following - previous), np.where(has_following, 1.0, 0.0))
+    interpolated = (1 - fraction)*previous_value + fraction*following_value
+
+    repaired = data.copy()
+    values = from_scan_frame(np.where(frame_mask, interpolated, frame), data.shape, rotation, scan_axis)
+    replace = mask & np.isfinite(values)
+    repaired[replace] = values[replace]
+    return repaired, mask
 
 def fourier_fringe_removal(data:np.array, threshold:float=None, line_width:int=1):
     return
     
-def align_rows_median_or_poly():
-    #TODO: Implement like gwyddion aligning scan rows. 
-    #Really just an individual line adjustment algorithm.
-    return
\ No newline at end of file
+def align_rows_median_or_poly(data: np.array, method: str = "median", order: int = 1, mask: np.array = None, trim: float = 0.25):
+    """
+    Aligns the scan rows, like Align Rows in Gwyddion. The fast scan axis is along the rows (last axis). 
+    All rows are corrected at once, so a stack (..., H, W) of channels is aligned in one call.
+
+    Methods
+    -------
+    median: subtracts the median of each row.
+    median_diff: shifts each row so that the median of its difference to the previous row is zero. Keeps the first row and the height steps across rows.
+    poly: subtracts a polynomial of the given order fitted to each row. The fits of all rows are one batched solve.
+    trimmed_mean: subtracts the mean of each row, without the fraction trim of the lowest and highest values.
+    matching: shifts each row to match the previous, with the differences weighted towards flat areas (small slopes along the row).
+
+    Parameters
+    ----------
+    data : np.array
+        The image (H, W), or a stack of images (..., H, W).
+    method : str, optional
+        "median", "median_diff", "poly", "trimmed_mean" or "matching". The default is "median".
+    order : int, optional
+        The order of the polynomial for "poly". The default is 1.
+    mask : np.array, optional
+        Boolean mask of the pixels used to compute the corrections, e.g. excluding particles. The correction is applied to all pixels. 
+        Rows without pixels in the mask are left unchanged. The default is None (all pixels).
+    trim : float, optional
+        The fraction trimmed from each end for "trimmed_mean". The default is 0.25.
+
+    Returns
+    -------
+    aligned : np.array
+        The aligned data.
+    """
+    data = np.asarray(data, dtype=float)
+    values = data if mask is None else np.where(mask, data, np.nan)
+
+    if method == "poly":
+        V = legendre.legvander(np.linspace(-1, 1, data.shape[-1]) if data.shape[-1] > 1 else np.zeros(1), order)
+        if mask is None:
+            coefficients = data @ V @ np.linalg.pinv(V.T @ V, hermitian=True)
+        else:
+            n = order + 1
+            weights = np.isfinite(values).astype(float)
+            G = (weights @ (V[:, :, None]*V[:, None, :]).reshape(-1, n*n)).reshape(weights.shape[:-1] + (n, n))
+            b = np.where(weights > 0, data, 0) @ V
+            coefficients = (np.linalg.pinv(G, hermitian=True) @ b[..., None])[..., 0]
+        return data - coefficients @ V.T
+
+    # Rows without pixels in the mask give NaN corrections (with warnings), which are set to zero below.
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if method == "median":
+            offsets = np.nanmedian(values, axis=-1) if mask is not None else np.median(values, axis=-1)
+
+        elif method == "trimmed_mean":
+            ordered = np.sort(values, axis=-1)
+            count = np.sum(np.isfinite(ordered), axis=-1)
+            lower = np.floor(trim*count).astype(int)
+            upper = count - lower
+            sums = np.concatenate([np.zeros(ordered.shape[:-1] + (1,)), np.cumsum(np.nan_to_num(ordered), axis=-1)], axis=-1)
+            offsets = (np.take_along_axis(sums, upper[..., None], -1) - np.take_along_axis(sums, lower[..., None], -1))[..., 0] / (upper - lower)
+
+        elif method in ["median_diff", "matching"]:
+            differences = values[..., 1:, :] - values[..., :-1, :]
+            if method == "median_diff":
+                steps = np.nanmedian(differences, axis=-1)
+            else:
+                slopes = np.abs(np.gradient(values, axis=-1)) if values.shape[-1] > 1 else np.zeros(values.shape)
+                slopes = slopes[..., 1:, :] + slopes[..., :-1, :]
+                scale = np.nanmedian(slopes)
+                weights = 1/(1 + (slopes/scale)**2) if scale > 0 else np.ones(slopes.shape)
+                weights = np.where(np.isfinite(differences), weights, 0)
+                steps = np.sum(weights*np.nan_to_num(differences), axis=-1) / np.sum(weights, axis=-1)
+            steps = np.nan_to_num(steps)
+            offsets = np.concatenate([np.zeros(steps.shape[:-1] + (1,)), np.cumsum(steps, axis=-1)], axis=-1)
+
+        else:
+            raise ValueError(f"Unknown method {method}. Use median, median_diff, poly, trimmed_mean or matching.")
+
+    return data - np.nan_to_num(offsets)[..., None]
\ No newline at end of file
@@ -333,17 +333,7 @@ class orientationPFM:
 
             data = self.gwyfile[ind]
 
-            hist, edges = np.histogram(data, bins=100)
-
-            pvalue = np.max(hist)
-            peak = edges[np.argmax(hist)]
-
-            lower = edges[np.where(hist > pvalue*0.5)[0][0]]
-            upper = edges[np.where(hist > pvalue*0.5)[0][-1]]
-
-            vmin = lower
-            vmax = upper
-
+            vmin, vmax = self.gwyfile.contrast_limits(ind, "normal", quantile=0.5)
 
 
             data = ndi.rotate(data, angle=self.orientation_deg, reshape=False)
@@ -371,11 +361,15 @@ class orientationPFM:
         - evaluate the fitting
         """
 
-        def merge_forward_backward():
+        def merge_forward_backward(crop=None):
             """
-            Merge the forward and backward scans
+            Merge the forward and backward scans.
+            If crop is given, only the cropped pixels are read from disk through lazy channel views.
             """
-            data = np.mean([self.gwyfile[self.LPFM_indices[i]] for i in range(len(self.LPFM_indices))], axis=0)
+            if crop is not None:
+                data = np.mean([self.gwyfile.get_lazy(self.LPFM_indices[i])[crop] for i in range(len(self.LPFM_indices))], axis=0)
+            else:
+                data = np.mean([self.gwyfile[self.LPFM_indices[i]] for i in range(len(self.LPFM_indices))], axis=0)
             return data
 
         def align_orientation(data):
@@ -387,15 +381,16 @@ class orientationPFM:
             data = ndi.rotate(data, self.orientation_deg, reshape=False)
             return data
 
-        def crop_grain(data):
+        def crop_grain(data, cropped=False):
             """
-            Crop the grain
+            Crop the grain. If cropped is True, data is already cropped to the grain.
             """
             # for index in self.LPFM_indices:
             #     #TODO: Prob x and y are switched.
             #     self.grain_arrays[index] = self.grain_arrays[index][self.grain_crop_y[0]:self.grain_crop_y[1], self.grain_crop_x[0]:self.grain_crop_x[1]]
 
-            data = data[self.grain_crop_y[0]:self.grain_crop_y[1], self.grain_crop_x[0]:self.grain_crop_x[1]]
+            if not cropped:
+                data = data[self.grain_crop_y[0]:self.grain_crop_y[1], self.grain_crop_x[0]:self.grain_crop_x[1]]
             self.grain_array = data
             if not self.automatic_whole_grain:
                     data = data[self.roi_crop_y[0]:self.roi_crop_y[1], self.roi_crop_x[0]:self.roi_crop_x[1]]
@@ -412,7 +407,13 @@ class orientationPFM:
             data = rest.denoise_bilateral(data, win_size=5, mode='symmetric')
             return data
 
-        if self.grain_array is None: 
+        if self.grain_array is None and self.orientation_deg % 360 == 0 and hasattr(self.gwyfile, "get_lazy"):
+            # No rotation needed, so only the grain is read from disk.
+            data = merge_forward_backward(crop=np.s_[self.grain_crop_y[0]:self.grain_crop_y[1], self.grain_crop_x[0]:self.grain_crop_x[1]])
+            data = crop_grain(data, cropped=True)
+            if filtering:
+                data= filtering(data)
+        elif self.grain_array is None: 
             data = merge_forward_backward()
             data = align_orientation(data)
             data = crop_grain(data)
@@ -0,0 +1,17 @@
+"""
+Readers for AFM (.gwy, .ibw) and SEM (.tif) data.
+The reader classes are exported lazily, see classes.py: a reader's dependencies are imported on first use.
+"""
+from .classes import exports, load_export
+
+__all__ = list(exports)
+
+
+def __getattr__(name: str):
+    value = load_export(name, __name__)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(exports))
@@ -0,0 +1,141 @@
+import numpy as np
+import h5py
+import os
+import time
+import tempfile
+import subprocess
+import sys
+import json
+
+try:
+    from .universal_reader import dataset_layout
+except ImportError:
+    from universal_reader import dataset_layout
+
+
+"""
+Small benchmarks for the hdf5 storage of converted scans and the import time of the readers.
+Run as a script to print the results, e.g. python benchmarks.py
+"""
+
+
+default_layouts = {
+    "contiguous": {},
+    "chunked": {"chunks": (256, 256)},
+    "lzf": {"compression": "lzf"},
+    "lzf+shuffle": {"compression": "lzf", "shuffle": True},
+    "gzip4": {"compression": "gzip", "compression_opts": 4},
+    "gzip4+shuffle": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    "blosc+shuffle": {"compression": "blosc", "shuffle": True},
+}
+
+
+def synthetic_scan(shape: tuple = (1024, 1024), seed: int = 0) -> np.ndarray:
+    """
+    Creates an AFM-like image: a tilted background, stripe domains and noise, quantized like a 16 bit ADC.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    data = 1e-3*x + 2e-3*y + np.sign(np.sin(2*np.pi*(x + 0.3*y)/64)) + 0.05*rng.standard_normal(shape)
+    return np.round(data*2**12)/2**12 * 1e-9
+
+
+def bench_layouts(data: np.ndarray = None, layouts: dict = None, repeats: int = 3, opath: str = None) -> list:
+    """
+    Benchmarks write speed, read speed and on-disk size of a channel for different dataset layouts.
+
+    Parameters
+    ----------
+    data: np.ndarray, optional
+        The channel to write. The default is a 1024x1024 synthetic scan.
+    layouts: dict, optional
+        Name to dataset_layout keyword arguments. The default is default_layouts.
+    repeats: int, optional
+        The number of repetitions. The best time is reported. The default is 3.
+    opath: str, optional
+        Folder for the temporary files. The default is the system temporary folder.
+
+    Returns
+    -------
+    results: list
+        One dict per layout with write_MBps, read_MBps, size_MB and ratio.
+    """
+    data = synthetic_scan() if data is None else data
+    layouts = default_layouts if layouts is None else layouts
+    nbytes = data.nbytes / 1e6
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=opath) as tmp:
+        for label, layout in layouts.items():
+            try:
+                kwargs = dataset_layout(data.shape, **layout)
+            except ImportError as error:
+                print(f"{label}: skipped ({error})")
+                continue
+
+            fname = os.path.join(tmp, label + ".hdf5")
+            write, read = np.inf, np.inf
+            for _ in range(repeats):
+                start = time.perf_counter()
+                with h5py.File(fname, "w") as f:
+                    f.create_group("channel")
+                    f["channel"].create_dataset("data", data=data, **kwargs)
+                write = min(write, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                with h5py.File(fname, "r") as f:
+                    np.array(f["channel"]["data"])
+                read = min(read, time.perf_counter() - start)
+
+            size = os.path.getsize(fname) / 1e6
+            results.append({"layout": label, "write_MBps": nbytes/write, "read_MBps": nbytes/read, "size_MB": size, "ratio": nbytes/size})
+
+    print(f"{'layout':<16}{'write MB/s':>12}{'read MB/s':>12}{'size MB':>10}{'ratio':>8}")
+    for result in results:
+        print(f"{result['layout']:<16}{result['write_MBps']:>12.1f}{result['read_MBps']:>12.1f}{result['size_MB']:>10.2f}{result['ratio']:>8.2f}")
+    return results
+
+
+heavy_modules = ["matplotlib", "pandas", "scipy", "tifffile", "hyperspy", "hystorian", "gwyfile", "igor2"]
+
+
+def bench_import(statement: str = "from universal_reader import GwyFile", repeats: int = 5) -> dict:
+    """
+    Benchmarks the cold import time of a statement in a fresh interpreter, with the IO folder on the path.
+    Also reports which heavy optional dependencies were imported by it, which should be none for GwyFile.
+
+    Parameters
+    ----------
+    statement: str, optional
+        The import statement. The default is "from universal_reader import GwyFile".
+    repeats: int, optional
+        The number of fresh interpreters. The best time is reported. The default is 5.
+
+    Returns
+    -------
+    result: dict
+        statement, seconds and the list of heavy modules that were imported.
+    """
+    script = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "seconds = time.perf_counter() - start\n"
+        f"print(json.dumps([seconds, [name for name in {heavy_modules!r} if name in sys.modules]]))\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")])
+
+    seconds, imported = np.inf, []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True).stdout
+        run_seconds, imported = json.loads(output.strip().splitlines()[-1])
+        seconds = min(seconds, run_seconds)
+
+    print(f"{statement}: {seconds*1e3:.1f} ms, heavy modules imported: {', '.join(imported) if imported else 'none'}")
+    return {"statement": statement, "seconds": seconds, "imported": imported}
+
+
+if __name__ == "__main__":
+    bench_layouts()
+    bench_import()
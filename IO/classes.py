@@ -1,30 +1,52 @@
-from typing import Any
-import numpy as np
-import h5py
-import os
-from glob import glob
-import sys
-import tifffile
-import re
-
-from universal_reader import find_key, GwyFile
-import ibw_io
-from ibw_io import CypherFile
-from sem import Tif2Hspy, Tif2H5, BatchTif2H5
-
-
-# import hyperspy.api as hs
-# import hystorian as hy
-
-
-
-
-
-    
-
-
-
-
-
-
-
+import importlib
+
+
+"""
+Collects the reader classes of the IO modules.
+The names are exported lazily: a reader module, and with it its dependencies (h5py, tifffile, hyperspy, hystorian, ...), 
+is only imported the first time one of its names is accessed. Reading a .gwy-derived hdf5 file with GwyFile therefore does not import the SEM or Cypher readers.
+
+Examples
+--------
+>>> from classes import GwyFile      # imports universal_reader only
+>>> from classes import CypherFile   # imports ibw_io on first use
+"""
+
+
+exports = {
+    "find_key": "universal_reader",
+    "KeyMatcher": "universal_reader",
+    "LazyChannel": "universal_reader",
+    "GwyFile": "universal_reader",
+    "GwyBatch": "universal_reader",
+    "query_store": "universal_reader",
+    "read_store_index": "universal_reader",
+    "CypherFile": "ibw_io",
+    "CypherBatch": "ibw_io",
+    "Tif2Hspy": "sem",
+    "Tif2H5": "sem",
+    "BatchTif2H5": "sem",
+    "ibw_io": "ibw_io",
+}
+
+__all__ = list(exports)
+
+
+def load_export(name: str, package: str = None):
+    """
+    Imports the module exporting name, relative to package if given, and returns the exported object.
+    """
+    if name not in exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module("." + exports[name], package) if package else importlib.import_module(exports[name])
+    return module if exports[name] == name else getattr(module, name)
+
+
+def __getattr__(name: str):
+    value = load_export(name, __package__)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(exports))
@@ -0,0 +1,184 @@
+import numpy as np
+import struct
+import re
+
+
+"""
+Streaming reader for the binary container of Gwyddion's .gwy-files ("GWYP" format), without the gwyfile package.
+
+The file is a serialized GwyContainer: an object is a NUL-terminated type name, a uint32 size and its components.
+A component is a NUL-terminated name, a one byte type code and the value:
+    b/c: 1 byte, i: int32, q: int64, d: double, s: NUL-terminated string, o: object,
+    C/I/Q/D: uint32 count followed by the array, S/O: uint32 count followed by strings/objects.
+All numbers are little-endian.
+
+Channels are stored as GwyDataField objects under "/N/data" with their title under "/N/data/title".
+Everything else (masks, presentations, graphs, thumbnails, logs, metadata) is skipped by seeking past it.
+"""
+
+
+fixed_sizes = {"b": 1, "c": 1, "i": 4, "q": 8, "d": 8}
+array_dtypes = {"C": np.dtype("u1"), "I": np.dtype("<i4"), "Q": np.dtype("<i8"), "D": np.dtype("<f8")}
+
+
+class GwyStreamReader:
+    """
+    Walks the object tree of a .gwy-file and yields each channel as soon as it is parsed.
+    Peak memory is bounded by one channel, since unneeded objects are never read into memory.
+
+    Attributes
+    ----------
+    fullpath: str
+        path to the .gwy-file
+
+    Examples
+    --------
+    >>> for kind, number, value in GwyStreamReader(fullpath):
+    ...     if kind == "datafield":
+    ...         print(number, value["data"].shape, value["unit"])
+    ...     elif kind == "title":
+    ...         print(number, value)
+    """
+
+    datafield_key = re.compile(r"^/(\d+)/data$")
+    title_key = re.compile(r"^/(\d+)/data/title$")
+
+    def __init__(self, fullpath: str):
+        self.fullpath = fullpath
+        with open(self.fullpath, "rb") as fh:
+            if fh.read(4) != b"GWYP":
+                raise ValueError(f"{self.fullpath} is not a GWYP .gwy-file.")
+        return
+
+    def __iter__(self):
+        """
+        Yields ("datafield", number, dict) with data, xreal, yreal and unit, and ("title", number, str),
+        in the order they appear in the file.
+        """
+        with open(self.fullpath, "rb") as fh:
+            fh.seek(4)
+            read_cstring(fh)
+            size = read_uint32(fh)
+            end = fh.tell() + size
+
+            while fh.tell() < end:
+                name = read_cstring(fh)
+                typecode = fh.read(1).decode()
+
+                datafield = self.datafield_key.match(name)
+                title = self.title_key.match(name)
+                if datafield is not None and typecode == "o":
+                    yield "datafield", int(datafield.group(1)), read_datafield(fh)
+                elif title is not None and typecode == "s":
+                    yield "title", int(title.group(1)), read_cstring(fh)
+                else:
+                    skip_value(fh, typecode)
+        return
+
+
+def read_cstring(fh) -> str:
+    """
+    Reads a NUL-terminated string.
+    """
+    chunks = []
+    while True:
+        chunk = fh.read(64)
+        if chunk == b"":
+            raise EOFError("Unexpected end of .gwy-file.")
+        pos = chunk.find(b"\0")
+        if pos >= 0:
+            chunks.append(chunk[:pos])
+            fh.seek(pos + 1 - len(chunk), 1)
+            return b"".join(chunks).decode("utf-8", errors="replace")
+        chunks.append(chunk)
+
+
+def read_uint32(fh) -> int:
+    return struct.unpack("<I", fh.read(4))[0]
+
+
+def skip_value(fh, typecode: str) -> None:
+    """
+    Seeks past a component value without reading it into memory.
+    """
+    if typecode in fixed_sizes:
+        fh.seek(fixed_sizes[typecode], 1)
+    elif typecode == "s":
+        read_cstring(fh)
+    elif typecode == "o":
+        read_cstring(fh)
+        fh.seek(read_uint32(fh), 1)
+    elif typecode in array_dtypes:
+        fh.seek(read_uint32(fh)*array_dtypes[typecode].itemsize, 1)
+    elif typecode == "S":
+        for _ in range(read_uint32(fh)):
+            read_cstring(fh)
+    elif typecode == "O":
+        for _ in range(read_uint32(fh)):
+            skip_value(fh, "o")
+    else:
+        raise ValueError(f"Unknown component type {typecode} in .gwy-file.")
+    return
+
+
+def read_value(fh, typecode: str):
+    """
+    Reads a scalar or string component value. Other values are skipped and None is returned.
+    """
+    if typecode == "i":
+        return struct.unpack("<i", fh.read(4))[0]
+    elif typecode == "q":
+        return struct.unpack("<q", fh.read(8))[0]
+    elif typecode == "d":
+        return struct.unpack("<d", fh.read(8))[0]
+    elif typecode == "s":
+        return read_cstring(fh)
+    skip_value(fh, typecode)
+    return None
+
+
+def read_datafield(fh) -> dict:
+    """
+    Reads a GwyDataField object. The data is read directly into a preallocated array.
+
+    Returns
+    -------
+    datafield: dict
+        data (yres, xres), xreal, yreal and unit (the z unit)
+    """
+    read_cstring(fh)
+    end = fh.tell() + read_uint32(fh)
+
+    fields = {"xreal": 1.0, "yreal": 1.0, "unit": ""}
+    data = None
+    while fh.tell() < end:
+        name = read_cstring(fh)
+        typecode = fh.read(1).decode()
+
+        if name == "data" and typecode == "D":
+            data = np.empty(read_uint32(fh), dtype="<f8")
+            fh.readinto(data)
+        elif name == "si_unit_z" and typecode == "o":
+            fields["unit"] = read_siunit(fh)
+        else:
+            fields[name] = read_value(fh, typecode)
+
+    fields["data"] = data.reshape(fields["yres"], fields["xres"])
+    return fields
+
+
+def read_siunit(fh) -> str:
+    """
+    Reads a GwySIUnit object, and returns its unit string.
+    """
+    read_cstring(fh)
+    end = fh.tell() + read_uint32(fh)
+
+    unit = ""
+    while fh.tell() < end:
+        name = read_cstring(fh)
+        typecode = fh.read(1).decode()
+        value = read_value(fh, typecode)
+        if name == "unitstr":
+            unit = value
+    return unit
@@ -1,14 +1,21 @@
 
 
 import numpy as np
-import pandas as pd
-import hystorian as hy
 import h5py
+import struct
+import re
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import os
 # Use glob or os.listdir to get a list of files in a directory. (glob is better, but os.listdir was used in the master's thesis)
 from glob import glob
-from universal_reader import find_key
+try:
+    from .universal_reader import KeyMatcher, GwyFile, add_to_store, build_pyramid, channel_stats, data_hash, timed_call, report_entry, print_report
+except ImportError:
+    from universal_reader import KeyMatcher, GwyFile, add_to_store, build_pyramid, channel_stats, data_hash, timed_call, report_entry, print_report
 
 
 """
@@ -34,6 +41,109 @@ and will be as follows:
 
 
 
+"""
+Native reader for Igor binary waves (.ibw, version 5), as saved by the Asylum Research Cypher AFMs.
+Hystorian is only imported if the legacy conversion is requested.
+
+Layout of a version 5 file:
+    BinHeader5 (64 bytes): version, checksum, wfmSize, formulaSize, noteSize, dataEUnitsSize, dimEUnitsSize[4], dimLabelsSize[4], sIndicesSize, options.
+    WaveHeader5 (320 bytes): among others npnts, type, bname, nDim[4], sfA[4], sfB[4], dataUnits, dimUnits[4].
+    Wave data (column-major, i.e. first dimension fastest), followed by formula, note, extended units, dimension labels and string indices.
+"""
+
+ibw_types = {2: "f4", 3: "c8", 4: "f8", 5: "c16", 8: "i1", 0x10: "i2", 0x20: "i4", 0x48: "u1", 0x50: "u2", 0x60: "u4"}
+
+
+def read_ibw(fullpath: str) -> dict:
+    """
+    Reads the header, data, note and dimension labels of an Igor binary wave (version 5).
+    The data is memory mapped, so no pixels are read until used.
+
+    Parameters
+    ----------
+    fullpath: str
+        path to the .ibw file
+
+    Returns
+    -------
+    wave: dict
+        name: str, the wave name
+        data: np.memmap, shape nDim (e.g. (x, y, layers) for Cypher images), Fortran-ordered
+        sfA, sfB: np.ndarray, the scaling (index value = sfA*e + sfB) of each dimension
+        units: str, the data units
+        dim_units: list, the units of each dimension
+        labels: list, for each dimension the list of labels; the first is the label of the dimension itself
+        note: str, the wave note
+    """
+    with open(fullpath, "rb") as fh:
+        bin_header = fh.read(64)
+        wave_header = fh.read(320)
+
+    order = "<"
+    if struct.unpack("<h", bin_header[:2])[0] not in [1, 2, 3, 5]:
+        order = ">"
+    version = struct.unpack(order + "h", bin_header[:2])[0]
+    assert version == 5, f"Only version 5 of Igor binary waves is supported, not {version}."
+
+    wfm_size, formula_size, note_size, data_eunits_size = struct.unpack(order + "4l", bin_header[4:20])
+    dim_eunits_size = struct.unpack(order + "4l", bin_header[20:36])
+    dim_labels_size = struct.unpack(order + "4l", bin_header[36:52])
+
+    npnts, wave_type = struct.unpack(order + "lh", wave_header[12:18])
+    name = wave_header[28:60].split(b"\0")[0].decode("ascii", errors="replace")
+    ndim = struct.unpack(order + "4l", wave_header[68:84])
+    sfa = np.array(struct.unpack(order + "4d", wave_header[84:116]))
+    sfb = np.array(struct.unpack(order + "4d", wave_header[116:148]))
+    units = wave_header[148:152].split(b"\0")[0].decode("ascii", errors="replace")
+    dim_units = [wave_header[152 + 4*d:156 + 4*d].split(b"\0")[0].decode("ascii", errors="replace") for d in range(4)]
+
+    assert wave_type in ibw_types, f"Unsupported wave type {wave_type}."
+    shape = tuple(n for n in ndim if n > 0)
+    data = np.memmap(fullpath, dtype=order + ibw_types[wave_type], mode="r", offset=64 + 320, shape=shape, order="F")
+
+    # Everything after the data.
+    with open(fullpath, "rb") as fh:
+        fh.seek(64 + wfm_size + formula_size)
+        note = fh.read(note_size).decode("latin-1")
+        eunits = fh.read(data_eunits_size).decode("latin-1")
+        dim_eunits = [fh.read(size).decode("latin-1") for size in dim_eunits_size]
+        labels = []
+        for size in dim_labels_size:
+            raw = fh.read(size)
+            labels.append([raw[i:i + 32].split(b"\0")[0].decode("latin-1") for i in range(0, size, 32)])
+
+    return {
+        "name": name,
+        "data": data,
+        "sfA": sfa[:len(shape)],
+        "sfB": sfb[:len(shape)],
+        "units": eunits if eunits else units,
+        "dim_units": [eunit if eunit else unit for eunit, unit in zip(dim_eunits, dim_units)],
+        "labels": labels,
+        "note": note,
+    }
+
+
+number_pattern = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+
+def parse_note(note: str) -> dict:
+    """
+    Parses an Asylum wave note of "Key: value" lines into a dictionary of typed values.
+    Integers and floats are converted, everything else is kept as a stripped string.
+    """
+    meta = {}
+    for line in re.split(r"[\r\n]+", note):
+        key, sep, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+        if not sep or not key:
+            continue
+        if number_pattern.match(value) is None:
+            meta[key] = value
+        elif re.fullmatch(r"[+-]?\d+", value):
+            meta[key] = int(value)
+        else:
+            meta[key] = float(value)
+    return meta
 
 
 class CypherFile:
@@ -44,27 +154,51 @@ class CypherFile:
             "C": ["Current", r"^C."],
             "D": ["DFL", "Deflection", r"^D."],
             "Z": ["ZSensor", r"^Z."],
-            # "V": ["Voltage"],
-            # "Amplitude": ["Amp", "Amplitude", "Mag"], TODO: Add these channels. Bit jalla, but okay.
-            # "Phase": ["Phase"],
+            "V": ["Voltage", "UserIn", r"^V."],
+            "A": ["Amp", "Amplitude", "Mag", r"^A."],
+            "P": ["Phase", r"^P."],
         }
     modes = {
             "T": ["F:", "Trace", "Forward", ".T$"],
             "R": ["B:", "Retrace", "Backward", ".R$" ],
             "R2": ["B2:", "Retrace2", "Backward2", ".R2$" ],
         }
+    matcher = KeyMatcher(keywords, modes)
+
+    # Categories of the channel names, as GwyFile, with the Asylum user inputs (UserIn0, ...) as voltages.
+    # Kept separate so the channel names of converted gwy-files do not change.
+    channel_matcher = KeyMatcher({**GwyFile.keywords, "Voltage": GwyFile.keywords["Voltage"] + ["UserIn"]}, GwyFile.modes)
+
+    # Asylum layer labels are <channel><Trace/Retrace>, e.g. "Current2Retrace", with short keys like "CR2" (see short_key). 
+    label_pattern = re.compile(r"^(?P<channel>.*?)(?P<mode>Trace|Retrace)$")
+    label_modes = {"Trace": "Forward", "Retrace": "Backward"}
     
 
     def __init__(self, path:str, filename:str, **kwargs):
         """
         path: path to folder
         filename: filename of scan
+
+        kwargs = {
+            "native": True,
+                convert with the native .ibw reader to the GwyFile channel layout. If False, hystorian is used.
+            "opath": None,
+                output folder of the hdf5 file. If None, the folder of the scan is used (always for hystorian).
+            "pyramid": None,
+                minimum side length of the coarsest level of a preview pyramid built at conversion, e.g. 64 (see universal_reader.build_pyramid).
+                Adds ~17 % to the size of the channels. If None, no pyramid is built.
+        }
         """
         self.path = path
         self.filename = filename
         self.fullpath = os.path.join(path, filename+".ibw")
-        self.opath = os.path.join(self.path, self.filename + ".hdf5")
-        self.kwargs = kwargs
+        self.kwargs = {
+            "native": True,
+            "opath": None,
+            "pyramid": None,
+        }
+        self.kwargs.update(kwargs)
+        self.opath = os.path.join(self.path if self.kwargs["opath"] is None else self.kwargs["opath"], self.filename + ".hdf5")
 
     def __call__(self):
         """
@@ -73,7 +207,7 @@ class CypherFile:
     
         self.convert_ibw()
 
-        im = self["CR"]
+        im = self[next(iter(self.load_channel_table().values()))] if self.kwargs["native"] else self["CR"]
         self.x_dim = im.shape[1]
         self.y_dim = im.shape[0]
 
@@ -83,6 +217,13 @@ class CypherFile:
         return
     
     def __getitem__(self, key_input: str) -> np.ndarray:
+        """
+        Returns the data of a channel by short key (e.g. "CR2"), Asylum label (e.g. "Current2Retrace") or channel name.
+        A list of keys returns the channels stacked into one array.
+        """
+
+        if isinstance(key_input, (list, tuple)):
+            return self.get_channels(key_input)
 
         def create_path(string: str) -> str:
             """
@@ -90,6 +231,15 @@ class CypherFile:
             """
             return r"datasets/"+rf"{os.path.join(self.path, self.filename)}" + r"/" + rf"{string}"
 
+        if self.is_native():
+            channel = self.lookup(key_input)
+            if channel is None:
+                print("Key not found in hdf5 file.")
+                print(key_input)
+                return
+            with h5py.File(self.opath, "r") as f:
+                return np.array(f[channel]["data"])
+
         keys2paths = {
             "CR2": create_path("Current2Retrace"),
             "CR": create_path("CurrentRetrace"),
@@ -102,7 +252,8 @@ class CypherFile:
         try:
             with h5py.File(self.opath, "r") as f:
                 key_input = f"{key_input}" #TODO: Add space or not?
-                key = find_key(CypherFile.keywords, key_input) + find_key(CypherFile.modes, key_input)
+                category, mode = CypherFile.matcher(key_input)
+                key = category + mode
 
                 return np.array(f[keys2paths[key]])
         except KeyError:
@@ -110,34 +261,104 @@ class CypherFile:
             print(keys2paths[key])
             return
     
-    def get_metadata(self)->pd.DataFrame:
+    def is_native(self) -> bool:
         """
-        Encodes and returns the metadata from the hdf5 file as a pd.DataFrame.
+        Returns True if the hdf5 file was converted by the native reader, i.e. has the GwyFile channel layout.
         """
+        if hasattr(self, "channel_table"):
+            return True
         with h5py.File(self.opath, "r") as f:
-            metadata = f[r"metadata/"+rf"{os.path.join(self.path, self.filename)}"]
-            strng= np.array(metadata).tolist().decode('ascii', errors='replace')
-            df = pd.DataFrame([sub.split(":") for sub in strng.split("\r")]).loc[:, :1]
-            df.set_index(0, inplace=True)
+            return "channel_names" in f
+
+    @staticmethod
+    def short_key(label: str) -> str:
+        """
+        Returns the short key of an Asylum label: category key, T/R for trace/retrace and any channel number,
+        e.g. "CurrentRetrace" -> "CR", "Current2Retrace" -> "CR2" and "UserIn0Trace" -> "VT0". None if the label is not recognized.
+        For layer number 0 the key without the number (e.g. "VT") also works, unless it is the short key of another layer.
+        """
+        match = CypherFile.label_pattern.match(label)
+        if match is None:
+            return None
+        channel = match.group("channel")
+        number = re.search(r"\d*$", channel).group()
+        category = CypherFile.matcher.find(channel[:len(channel) - len(number)])
+        if category is None:
+            return None
+        return category + match.group("mode")[0] + number
+
+    def load_channel_table(self) -> dict:
+        """
+        Loads the channel table written at conversion, which maps short keys, labels and channel names to channel names.
+        The table is cached in self.channel_table.
+        """
+        if not hasattr(self, "channel_table"):
+            with h5py.File(self.opath, "r") as f:
+                self.channel_table = json.loads(f["channel_table"][()])
+        return self.channel_table
+
+    def lookup(self, key_input: str) -> str:
+        """
+        Returns the channel name of a short key, label or channel name, or None if not found.
+        """
+        table = self.load_channel_table()
+        if key_input in table:
+            return table[key_input]
+
+        # Tables of older conversions have no short keys without the layer number 0, e.g. "VT" for "VT0".
+        if key_input + "0" in table:
+            return table[key_input + "0"]
+
+        category, mode = CypherFile.matcher(key_input)
+        if category is None or mode is None:
+            return None
+        return table.get(category + mode)
+
+    def get_channels(self, keys: list) -> np.ndarray:
+        """
+        Returns several channels stacked into one array of shape (N, H, W), read through one file handle.
+
+        Parameters
+        ----------
+        keys: list
+            Short keys, labels or channel names, e.g. ["CT", "CR", "AR", "PR"].
+        """
+        channels = [self.lookup(key) for key in keys]
+        missing = [key for key, channel in zip(keys, channels) if channel is None]
+        assert len(missing) == 0, f"Keys not found in hdf5 file: {missing}"
+
+        with h5py.File(self.opath, "r") as f:
+            return np.stack([f[channel]["data"][()] for channel in channels])
+
+    def get_metadata(self)->dict:
+        """
+        Returns the metadata of the note as a dictionary of typed values (int, float or str).
+        Natively converted files store the parsed note at conversion, so this is a single read. 
+        Notes of hystorian files are parsed here. The result is cached in self.meta.
+        """
+        with h5py.File(self.opath, "r") as f:
+            if "metadata" in f and isinstance(f["metadata"], h5py.Dataset):
+                self.meta = json.loads(f["metadata"][()])
+            else:
+                metadata = f[r"metadata/"+rf"{os.path.join(self.path, self.filename)}"]
+                self.meta = parse_note(np.array(metadata).tolist().decode('ascii', errors='replace'))
         
-        self.meta = df
-        return df
+        return self.meta
     
-    def get_metadata_key(self, key:str) ->pd.DataFrame.items:
+    def get_metadata_key(self, key:str):
         """
         Returns the value of a metadata key.
         """
-        try:
-            return self.meta.loc[key].item()
-        except AttributeError:
+        if not hasattr(self, "meta"):
             self.get_metadata()
-            return self.meta.loc[key].item()
+        return self.meta[key]
 
 
     def hy_apply(self, function: callable, *args, **kwargs):
         """
         Applies a function to the data in the hdf5 file.
         """
+        import hystorian as hy
         hy.m_apply(self.fullpath, function, *args, **kwargs)
         return
     
@@ -155,21 +376,235 @@ class CypherFile:
         """
         Part of the CypherFile class.
         Converts the ibw file to hdf5.
+        By default with the native reader (read_ibw), which writes the same channel layout as GwyFile: 
+        one group per layer named category_mode_index with the data, title, category, mode, unit, xsize, ysize, xres and the Asylum label,
+        plus channel_names, the wave note, the parsed metadata and the channel table. If kwargs["native"] is False, hystorian is used.
         """
 
-        hy.io.read_file.tohdf5(self.fullpath)
+        if not self.kwargs["native"]:
+            import hystorian as hy
+            hy.io.read_file.tohdf5(self.fullpath)
+            return
 
+        wave = read_ibw(self.fullpath)
+        data = wave["data"] if wave["data"].ndim == 3 else wave["data"][:, :, None]
+        labels = wave["labels"][2][1:] if len(wave["labels"]) > 2 and len(wave["labels"][2]) > 1 else [wave["name"]]
+
+        channel_names = []
+        channel_table = {}
+        short_keys = []
+        with h5py.File(self.opath, "w") as f:
+            for id, label in enumerate(labels[:data.shape[2]]):
+                match = CypherFile.label_pattern.match(label)
+                channel, mode = (match.group("channel"), CypherFile.label_modes[match.group("mode")]) if match else (label, None)
+                category = str(CypherFile.channel_matcher.find(channel))
+
+                name = f"{category}_{mode}_{id}"
+                channel_names.append(name)
+
+                # Igor stores x along the first dimension, so the transposed layer has one scan line per row.
+                layer = data[:, :, id].T
+                f.create_group(name)
+                f[name].create_dataset("data", data=layer)
+                f[name].attrs["title"] = name
+                f[name].attrs["category"] = category
+                f[name].attrs["mode"] = str(mode)
+                f[name].attrs["unit"] = wave["units"]
+                f[name].attrs["xsize"] = wave["sfA"][0] * layer.shape[1]
+                f[name].attrs["ysize"] = wave["sfA"][1] * layer.shape[0]
+                f[name].attrs["xres"] = wave["sfA"][0]
+                f[name].attrs["label"] = label
+                f[name].attrs.update(channel_stats(layer))
+                f[name].attrs["data_hash"] = data_hash(layer)
+                if self.kwargs["pyramid"] is not None:
+                    build_pyramid(f[name], layer, self.kwargs["pyramid"])
+
+                # Names and labels are always in the table, short keys only for the first layer having it.
+                short = CypherFile.short_key(label)
+                channel_table[name] = name
+                channel_table.setdefault(label, name)
+                if short is not None:
+                    channel_table.setdefault(short, name)
+                    short_keys.append((short, name))
+
+            # Short keys of layer number 0 are also registered without the number (VT for VT0), unless it is an exact key.
+            for short, name in short_keys:
+                match = re.fullmatch(r"(.*\D)0", short)
+                if match is not None:
+                    channel_table.setdefault(match.group(1), name)
+
+            f.create_dataset("channel_names", data=np.array(channel_names, dtype="S"))
+            f.create_dataset("note", data=np.bytes_(wave["note"].encode("latin-1")))
+            f.create_dataset("metadata", data=json.dumps(parse_note(wave["note"])))
+            f.create_dataset("channel_table", data=json.dumps(channel_table))
+            f.attrs["source_mtime"] = os.stat(self.fullpath).st_mtime
+            f.attrs["source_size"] = os.stat(self.fullpath).st_size
+
+        self.channel_table = channel_table
         return
 
 
     def convert_batch_ibw(self):
         """
-        Part of the CypherBatch class.
-        Converts all ibw files in the folder to hdf5.
-        TODO: Figure out the naming when several files are merged. 
+        Converts all ibw files in the folder to one merged hdf5 store, <filename>_batch.hdf5, with CypherBatch.
+        The store is separate from the hdf5 file of this instance, which is still read by __getitem__.
+
+        Returns
+        -------
+        batch: CypherBatch
+            The batch, with the path of the store in batch.opath and the report in batch.report.
         """
+        batch = CypherBatch(self.path, store=self.filename + "_batch")
+        batch()
+
+        return batch
+
+
+def convert_cypher(path: str, filename: str, opath: str) -> tuple:
+    """
+    Converts a single ibw file natively with CypherFile.convert_ibw. Worker function of CypherBatch.
+
+    Returns
+    -------
+    tuple
+        filename, seconds spent and the error message (None if successful), see universal_reader.timed_call.
+    """
+    return timed_call(filename, lambda: CypherFile(path, filename, opath=opath).convert_ibw())
+
+
+class CypherBatch:
+    """
+    Converts all ibw files of a Cypher session folder into one merged hdf5 store, with one group per scan named after the file 
+    and a top-level index table (see universal_reader.read_store_index).
+    Files are parsed in parallel worker processes, and merged into the store one at a time as they finish.
+    A progress manifest (<store>.manifest.json) records every merged scan with the modification time and size of its ibw file, 
+    so an interrupted run resumes where it stopped, and only new or modified files are converted on reruns.
+
+    A scan in the store has the GwyFile channel layout, and can be read with GwyFile(path, scan, oname=store, group=scan).
+
+    Attributes
+    ----------
+    path: str
+        path to the session folder
+    **kwargs: dict, optional
+        The default is:
+
+            {
+            "store": "CypherBatch",
+                name of the merged hdf5 store.
+            "opath": None,
+                output folder of the store. If None, path is used.
+            "pattern": "*.ibw",
+                glob pattern of the files to convert.
+            "workers": None,
+                number of worker processes. None uses the number of processors, 1 converts in this process.
+            }
+
+    Methods
+    -------
+    __call__:
+        Converts and merges the files that are not done yet, and returns the report.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        self.kwargs = {
+            "store": "CypherBatch",
+            "opath": None,
+            "pattern": "*.ibw",
+            "workers": None,
+        }
+
+        for key, value in kwargs.items():
+            if key in self.kwargs:
+                self.kwargs[key] = value
 
-        hy.io.read_file.merge_hdf5(self.scans, self.filename)
-        self.opath = os.path.join(self.path, self.filename + ".hdf5")
+        self.path = path
+        opath = self.path if self.kwargs["opath"] is None else self.kwargs["opath"]
+        self.opath = os.path.join(opath, self.kwargs["store"] + ".hdf5")
+        self.manifest_path = os.path.join(opath, self.kwargs["store"] + ".manifest.json")
 
-        return
\ No newline at end of file
+        self.scans = sorted(os.path.basename(file)[:-4] for file in glob(os.path.join(self.path, self.kwargs["pattern"])) if file.endswith(".ibw"))
+        self.report = []
+        print(f"{len(self.scans)} ibw files found.")
+        return
+
+    def load_manifest(self) -> dict:
+        """
+        Returns the progress manifest: scan -> {"mtime", "size"} of the merged ibw files.
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: dict) -> None:
+        """
+        Writes the progress manifest atomically, so an interruption never leaves it half written.
+        """
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+        return
+
+    def is_done(self, scan: str, manifest: dict, groups: set) -> bool:
+        """
+        Returns True if the scan is merged into the store from the current version of its ibw file.
+        """
+        stat = os.stat(os.path.join(self.path, scan + ".ibw"))
+        entry = manifest.get(scan)
+        return scan in groups and entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+
+    def __call__(self) -> list:
+        """
+        Converts the remaining ibw files, merges them into the store and prints a summary.
+
+        Returns
+        -------
+        report: list
+            One dict per file with filename, status ("converted", "skipped" or "failed"), seconds and error.
+        """
+        manifest = self.load_manifest()
+        groups = set()
+        if os.path.exists(self.opath):
+            with h5py.File(self.opath, "r") as f:
+                groups = set(f.keys())
+
+        self.report = []
+        todo = []
+        for scan in self.scans:
+            if self.is_done(scan, manifest, groups):
+                self.report.append(report_entry(scan, 0.0, status="skipped"))
+            else:
+                todo.append(scan)
+
+        tmpdir = tempfile.mkdtemp(dir=os.path.dirname(self.opath))
+
+        def merge_scan(filename):
+            add_to_store(os.path.join(tmpdir, filename + ".hdf5"), self.opath, filename)
+            os.remove(os.path.join(tmpdir, filename + ".hdf5"))
+            stat = os.stat(os.path.join(self.path, filename + ".ibw"))
+            manifest[filename] = {"mtime": stat.st_mtime, "size": stat.st_size}
+            self.save_manifest(manifest)
+
+        def merge(result):
+            filename, seconds, error = result
+            if error is None:
+                _, merge_seconds, error = timed_call(filename, merge_scan, filename)
+                seconds += merge_seconds
+            self.report.append(report_entry(filename, seconds, error))
+
+        try:
+            if self.kwargs["workers"] == 1:
+                for scan in todo:
+                    merge(convert_cypher(self.path, scan, tmpdir))
+            else:
+                with ProcessPoolExecutor(max_workers=self.kwargs["workers"]) as executor:
+                    futures = [executor.submit(convert_cypher, self.path, scan, tmpdir) for scan in todo]
+                    for future in as_completed(futures):
+                        merge(future.result())
+        finally:
+            shutil.rmtree(tmpdir)
+
+        print_report(self.report)
+        return self.report
@@ -4,8 +4,14 @@ import numpy as np
 import h5py
 import os
 from glob import glob
-import tifffile
-import hyperspy.api as hs
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .universal_reader import dataset_layout
+except ImportError:
+    from universal_reader import dataset_layout
 
 def tif_init_setup(obj, kwargs: dict, extension: str):
     """
@@ -40,10 +46,70 @@ def tif_init_setup(obj, kwargs: dict, extension: str):
     return
 
 
+def find_tifs(path: str, filename: str) -> list:
+    """
+    Returns the sorted .tif/.tiff files in a folder starting with filename.
+    """
+    possible_files = glob(os.path.join(path, filename+"*"))
+    return sorted(file for file in possible_files if file.endswith(".tif") or file.endswith(".tiff"))
+
+
+def read_tif(fullpath: str) -> tuple:
+    """
+    Opens a tif file once, decodes the image and reads the FEI metadata from the tags.
+
+    Parameters
+    ----------
+    fullpath: str
+        path to the tif file
+
+    Returns
+    -------
+    img: np.ndarray
+        the first image series, (y, x) or (pages, y, x)
+    meta: dict
+        xres and yres (pixel size in m, NaN if the file has no FEI metadata) and the FEI metadata as a dict
+    """
+    import tifffile
+
+    with tifffile.TiffFile(fullpath) as tif:
+        fei = tif.fei_metadata or {}
+        series = tif.series[0]
+        img = np.empty(series.shape, dtype=series.dtype)
+        series.asarray(out=img)
+
+    escan = fei.get("EScan", {})
+    meta = {
+        "xres": escan.get("PixelWidth", np.nan),
+        "yres": escan.get("PixelHeight", np.nan),
+        "fei_metadata": fei,
+    }
+    return img, meta
+
+
+def write_tif(f: h5py.File, name: str, img: np.ndarray, meta: dict, layout: dict = None) -> None:
+    """
+    Writes an image and its metadata to a group in an open hdf5 file.
+    The dataset is allocated with the given layout (see dataset_layout) before the image is written to it.
+    """
+    layout = {} if layout is None else layout
+    f.create_group(name)
+    dset = f[name].create_dataset("data", shape=img.shape, dtype=img.dtype, **layout)
+    dset[...] = img
+    f[name].attrs["name"] = name
+    f[name].attrs["xsize"] = img.shape[-1]
+    f[name].attrs["ysize"] = img.shape[-2]
+    f[name].attrs["xres"] = meta["xres"]
+    f[name].attrs["yres"] = meta["yres"]
+    f[name].attrs["fei_metadata"] = json.dumps(meta["fei_metadata"], default=str)
+    return
+
+
 
 class Tif2Hspy:
     """
-    Class for handling SEM images using hyperspy
+    Class for handling SEM images using hyperspy.
+    hyperspy is imported the first time the hspy path is used, and the loaded signal is cached for the lifetime of the object.
 
     Attributes
     ----------
@@ -55,13 +121,19 @@ class Tif2Hspy:
         keyword arguments for the class
             opath : str
                 output path for the hyperspy file
+            lazy : bool
+                whether the signal is loaded lazily, backed by a dask array
+    signal : hyperspy signal
+        the cached signal, None until loaded
     
     Methods
     -------
     __call__()
         Loads the tif file and saves it as a hyperspy file.
+    load()
+        Returns the cached hyperspy signal, loading it from the hyperspy file if needed.
     __getitem__(key:str)
-        Returns the hyperspy object
+        Returns the hyperspy data
 
     """
 
@@ -79,14 +151,17 @@ class Tif2Hspy:
             keyword arguments for the class
                 opath : str, optional
                     output path for the hyperspy file. Default is None.
+                lazy : bool, optional
+                    whether the signal is loaded lazily, backed by a dask array. Default is False.
         """
         self.kwargs = {
             "opath": None,
-
+            "lazy": False,
         }
 
         self.path = path
         self.filename = filename
+        self.signal = None
 
         tif_init_setup(self, kwargs, ".hspy")
 
@@ -96,16 +171,28 @@ class Tif2Hspy:
         """
         Loads the tif file and saves it as a hyperspy file.
         """
+        import hyperspy.api as hs
 
         img = hs.load(self.fullpath)
         img.save(self.opath)
 
-        meta = img.metadata
         self.x_dim = img.axes_manager["width"].size #meta["Signal"].axes_manager[0].size
         self.x_res = img.axes_manager["width"].scale #meta["Signal"].axes_manager[0].scale #TODO: Check if correct.
 
+        self.signal = None if self.kwargs["lazy"] else img
+
         return
     
+    def load(self):
+        """
+        Returns the cached hyperspy signal. The hyperspy file is only read on the first call.
+        If kwargs["lazy"] is True, the data of the signal is a dask array, read when computed.
+        """
+        if self.signal is None:
+            import hyperspy.api as hs
+            self.signal = hs.load(self.opath, lazy=self.kwargs["lazy"])
+        return self.signal
+
     def __getitem__(self, key: str = '') -> np.ndarray:
         """
         Returns the data from hyperspy, possibly with metadata.
@@ -118,11 +205,9 @@ class Tif2Hspy:
         Returns
         -------
         np.ndarray
-            The hyperspy data possibly with metadata.
+            The hyperspy data possibly with metadata. A dask array if kwargs["lazy"] is True.
         """
-
-
-        h = hs.load(self.opath)
+        h = self.load()
         if key == "all":
             return (h.data, h.metadata) #TODO: Keep this?
         else:
@@ -192,35 +277,18 @@ class Tif2H5:
             The index of the file. Default is 0.
         """
 
-        img = tifffile.imread(self.fullpath)
-        meta = tifffile.TiffFile(self.fullpath) #TODO: Currently not working. 
-
-        print(meta)
+        img, meta = read_tif(self.fullpath)
 
-        self.x_dim = img.shape[1]
-        self.y_dim = img.shape[0]
+        self.x_dim = img.shape[-1]
+        self.y_dim = img.shape[-2]
 
-        self.x_res = meta.fei_metadata['EScan']['PixelWidth']
-        self.y_res = meta.fei_metadata['EScan']['PixelHeight']
+        self.x_res = meta["xres"]
+        self.y_res = meta["yres"]
 
         self.name = str(index).zfill(2)
 
-        #TODO: Save to hdf5 file but necessary?
         with h5py.File(self.opath, "w") as f:
-            
-            f.create_group(self.name)
-            f[self.name].create_dataset("data", data=img)
-            # f.attrs["title"] = name
-            # f.attrs["category"] = category
-            # f.attrs["mode"] = mode
-            # f.attrs["unit"] = channels[key].si_unit_z.unitstr
-            f[self.name].attrs["name"] = self.name
-            f[self.name].attrs["xsize"] = self.x_dim
-            f[self.name].attrs["ysize"] = self.y_dim
-            f[self.name].attrs["xres"] = self.x_res
-
-            # f.create_dataset("channel_names", data=np.array(self.channel_names, dtype="S") ) TODO: In batch
-
+            write_tif(f, self.name, img, meta)
 
         return 
     
@@ -249,6 +317,10 @@ class BatchTif2H5(Tif2H5):
                 name of the hdf5 file
             existing : bool
                 whether the file already exists
+            workers : int
+                number of threads decoding tif files
+            chunks, compression, compression_opts, shuffle
+                dataset layout, see universal_reader.dataset_layout
     
     Methods
     -------
@@ -276,13 +348,27 @@ class BatchTif2H5(Tif2H5):
                     name of the hdf5 file. Default is "SEM_batch".
                 existing : bool, optional
                     whether the file already exists. Default is False.
+                workers : int, optional
+                    number of threads decoding tif files. Default is None (ThreadPoolExecutor's default).
+                chunks : tuple, optional
+                    chunk shape of the datasets. Default is True (tiles of at most 256x256 pixels).
+                compression : str, optional
+                    "gzip", "lzf" or "blosc". Default is None.
+                compression_opts : int, optional
+                    compression level. Default is None.
+                shuffle : bool, optional
+                    whether to apply the byte shuffle filter. Default is False.
         """
 
         self.kwargs = {
             "opath": None,
             "oname": "SEM_batch",
             "existing": False,
-
+            "workers": None,
+            "chunks": True,
+            "compression": None,
+            "compression_opts": None,
+            "shuffle": False,
         }
 
         self.path = path
@@ -295,11 +381,7 @@ class BatchTif2H5(Tif2H5):
         if self.kwargs["existing"]:
             self.opath = os.path.join(self.path, self.kwargs["oname"]  + ".hdf5") if self.kwargs["opath"] is None else os.path.join(self.kwargs["opath"], self.kwargs["oname"]  + ".hdf5")
         else:
-            possible_files = glob(os.path.join(self.path, self.filename+"*"))
-
-            for file in possible_files:
-                if not(file.endswith(".tif")) or not(file.endswith(".tiff")):
-                    possible_files.remove(file)
+            possible_files = find_tifs(self.path, self.filename)
 
             assert len(possible_files) > 0, "No tif/tiff files found."
 
@@ -312,23 +394,35 @@ class BatchTif2H5(Tif2H5):
     def __call__(self):
         """
         Creates the hdf5 file for data analysis.
+        The tif files are decoded concurrently in a thread pool, while the main thread writes them in order.
+        At most two files per worker are held in memory.
         """
+        layout_kwargs = {key: self.kwargs[key] for key in ["chunks", "compression", "compression_opts", "shuffle"]}
 
-        with h5py.File(self.opath, "w") as f: #TODO: Option for adding and editing files?
+        workers = self.kwargs["workers"] or min(32, (os.cpu_count() or 1) + 4)
+
+        with h5py.File(self.opath, "w") as f, ThreadPoolExecutor(workers) as pool: #TODO: Option for adding and editing files?
             self.channel_names = []
-            for index, file in enumerate(self.fullpaths):
-                img = tifffile.imread(file)
-                meta = tifffile.tiffFile(file) #TODO: Currently not working. 
+            window = 2*workers
+            files = iter(enumerate(self.fullpaths))
+            pending = deque()
+
+            while True:
+                while len(pending) < window:
+                    index, file = next(files, (None, None))
+                    if file is None:
+                        break
+                    pending.append((index, file, pool.submit(read_tif, file)))
+                if len(pending) == 0:
+                    break
+
+                index, file, future = pending.popleft()
+                img, meta = future.result()
 
                 name = str(index).zfill(2)
                 self.channel_names.append(name)
-
-                f.create_group(name)
-                f[name].create_dataset("data", data=img)
-                f[name].attrs["name"] = name
-                f[name].attrs["xsize"] = img.shape[1]
-                f[name].attrs["ysize"] = img.shape[0]
-                f[name].attrs["xres"] = meta.fei_metadata['EScan']['PixelWidth']
+                write_tif(f, name, img, meta, dataset_layout(img.shape, **layout_kwargs))
+                f[name].attrs["filename"] = os.path.basename(file)
 
             f.create_dataset("channel_names", data=np.array(self.channel_names, dtype="S") )
         return
@@ -345,6 +439,7 @@ class BatchTif2H5(Tif2H5):
                 "xsize": f[name].attrs["xsize"],
                 "ysize": f[name].attrs["ysize"],
                 "xres": f[name].attrs["xres"],
+                "yres": f[name].attrs["yres"],
             }
         return meta
 
@@ -1,14 +1,22 @@
 from typing import Any
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm, patches
 import h5py
-import pandas as pd
 import os
 from glob import glob
 import sys
-import gwyfile as gwy
 import re
+import contextlib
+import hashlib
+import json
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from .gwy_io import GwyStreamReader
+except ImportError:
+    from gwy_io import GwyStreamReader
 
 
 
@@ -17,20 +25,561 @@ GwyFile from classes.py was copied over so that the class could be imported in e
 TODO: Do the same for CypherFile, and use classes to do relative imports of the different classes in case one wants to import all of them. 
 """
 
+def compile_keywords(keywords: dict) -> re.Pattern:
+    """
+    Compiles a keywords dictionary into a single regex. 
+    Each key becomes an alternative with a lookahead for any of its patterns, followed by an empty named group.
+    Alternatives are tried in dictionary order at the start of the title, so the first key with a pattern found anywhere in the title wins,
+    exactly as when looping over the dictionary with re.search.
+    """
+    alternatives = [rf"(?=.*?(?:{'|'.join(elems)}))(?P<key{i}>)" for i, elems in enumerate(keywords.values()) if len(elems) > 0]
+    return re.compile("|".join(alternatives) if alternatives else "(?!)", re.DOTALL)
+
+
+class KeyMatcher:
+    """
+    Precompiled, memoized classification of channel titles into category and mode.
+    Each keywords/modes table is compiled once into a single regex (see compile_keywords), 
+    and every title is only matched the first time it is seen.
+
+    Attributes
+    ----------
+    keywords: dict
+        category to list of regex patterns
+    modes: dict, optional
+        mode to list of regex patterns
+
+    Examples
+    --------
+    >>> matcher = KeyMatcher(GwyFile.keywords, GwyFile.modes)
+    >>> matcher("LPFM Amplitude Forward")
+    ('LPFM', 'Forward')
+    """
+
+    def __init__(self, keywords: dict, modes: dict = None):
+        self.keywords = keywords
+        self.modes = modes
+        self._keys = {"keywords": list(keywords.keys()), "modes": [] if modes is None else list(modes.keys())}
+        self._patterns = {"keywords": compile_keywords(keywords), "modes": None if modes is None else compile_keywords(modes)}
+        self.cache = {}
+        return
+
+    def find(self, title: str, table: str = "keywords", verbose: bool = True) -> str:
+        """
+        Returns the first key of the table ("keywords" or "modes") with a pattern found in title, or None.
+        Prints a message if nothing is found and verbose is True.
+        """
+        match = self._patterns[table].match(title)
+        if match is None:
+            if verbose:
+                print(title, "not found in keywords dictionary.")
+            return None
+        return self._keys[table][int(match.lastgroup[3:])]
+
+    def __call__(self, title: str) -> tuple:
+        """
+        Returns (category, mode) of title. Mode is None if no modes table is given.
+        """
+        try:
+            return self.cache[title]
+        except KeyError:
+            result = (self.find(title), None if self.modes is None else self.find(title, "modes"))
+            self.cache[title] = result
+            return result
+
+
+_matchers = {}
+
 def find_key(keywords: dict, title: str) -> str:
         """
         Finds the key in the keywords dictionary based on channel title.
         Universal function for all classes.
+        The keywords dictionary is compiled once, and the result of each title is memoized (see KeyMatcher).
         """
 
-        for key, elems in keywords.items():
-            for elem in elems:
-                match = re.search(elem, title)
-                if match is not None:
-                    return key
-                
-        print(title, "not found in keywords dictionary.")
-        return None
+        matcher = _matchers.get(id(keywords))
+        if matcher is None or matcher.keywords != keywords:
+            matcher = KeyMatcher(dict(keywords))
+            _matchers[id(keywords)] = matcher
+        return matcher(title)[0]
+
+
+
+def dataset_layout(shape: tuple, chunks: tuple = None, compression: str = None, compression_opts: int = None, shuffle: bool = False) -> dict:
+    """
+    Returns the keyword arguments for h5py's create_dataset for a given storage layout of a channel.
+    Without compression, chunks or shuffle, the dataset is contiguous, which allows memory mapping (see LazyChannel).
+
+    Parameters
+    ----------
+    shape: tuple
+        The shape of the dataset.
+    chunks: tuple, optional
+        The chunk shape. If None and the data is compressed, tiles of at most 256x256 pixels are used.
+    compression: str, optional
+        "gzip", "lzf" or "blosc". Blosc requires the hdf5plugin package. The default is None.
+    compression_opts: int, optional
+        The compression level for gzip (0-9) or blosc (0-9). The default is None.
+    shuffle: bool, optional
+        Whether to apply the byte shuffle filter, which often improves compression of floating point images. The default is False.
+
+    Returns
+    -------
+    layout: dict
+    """
+    if chunks is None and compression is None and not shuffle:
+        return {}
+
+    if chunks is None or chunks is True:
+        chunks = (256,)*len(shape)
+    layout = {"chunks": tuple(max(1, min(chunk, size)) for chunk, size in zip(chunks, shape))}
+
+    if compression == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("Blosc compression requires the hdf5plugin package.")
+        blosc = hdf5plugin.Blosc(cname="lz4", clevel=5 if compression_opts is None else compression_opts,
+                                  shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE)
+        layout.update(blosc)
+        return layout
+
+    if compression is not None:
+        assert compression in ["gzip", "lzf"], "Compression must be gzip, lzf or blosc."
+        layout["compression"] = compression
+        if compression_opts is not None:
+            layout["compression_opts"] = compression_opts
+    if shuffle:
+        layout["shuffle"] = True
+    return layout
+
+
+
+def is_up_to_date(fullpath: str, opath: str, group: str = None) -> bool:
+    """
+    Checks if a converted hdf5 file matches its source file, by comparing the modification time and size stored at conversion.
+
+    Parameters
+    ----------
+    fullpath: str
+        path to the source file
+    opath: str
+        path to the hdf5 file
+    group: str, optional
+        the scan group, if opath is a consolidated store
+
+    Returns
+    -------
+    bool
+    """
+    if not os.path.exists(opath):
+        return False
+    stat = os.stat(fullpath)
+    try:
+        with h5py.File(opath, "r") as f:
+            root = f if group is None else f[group]
+            return root.attrs["source_mtime"] == stat.st_mtime and root.attrs["source_size"] == stat.st_size
+    except (OSError, KeyError):
+        return False
+
+
+
+store_index_dtype = np.dtype([
+    ("scan", h5py.string_dtype()),
+    ("channel", h5py.string_dtype()),
+    ("category", h5py.string_dtype()),
+    ("mode", h5py.string_dtype()),
+    ("unit", h5py.string_dtype()),
+    ("xsize", "f8"),
+    ("ysize", "f8"),
+    ("xres", "f8"),
+])
+
+
+def store_rows(group: h5py.Group) -> list:
+    """
+    Returns the index rows of a scan group in a consolidated store, read from channel attributes only.
+    """
+    scan = group.name.split("/")[-1]
+    rows = []
+    for channel in np.array(group["channel_names"], dtype=str):
+        attrs = group[channel].attrs
+        rows.append((scan, str(channel), str(attrs["category"]), str(attrs["mode"]), str(attrs["unit"]),
+                     float(attrs["xsize"]), float(attrs["ysize"]), float(attrs["xres"])))
+    return rows
+
+
+def update_store_index(f: h5py.File, scan: str, rows: list) -> None:
+    """
+    Replaces the rows of a scan in the top-level "index" table of a consolidated store.
+
+    Parameters
+    ----------
+    f: h5py.File
+        The store, opened writable.
+    scan: str
+        The scan group name.
+    rows: list
+        The new rows of the scan (see store_rows). Empty to remove the scan from the index.
+    """
+    old = f["index"][()] if "index" in f else np.zeros(0, dtype=store_index_dtype)
+    scans = np.array([row.decode() if isinstance(row, bytes) else row for row in old["scan"]], dtype=object)
+    keep = old[scans != scan] if len(old) > 0 else old
+    index = np.concatenate([keep.astype(store_index_dtype), np.array(rows, dtype=store_index_dtype)])
+
+    if "index" in f:
+        del f["index"]
+    f.create_dataset("index", data=index, maxshape=(None,))
+    return
+
+
+def read_store_index(opath: str) -> list:
+    """
+    Reads the index table of a consolidated store without touching pixel data.
+
+    Parameters
+    ----------
+    opath: str
+        path to the store
+
+    Returns
+    -------
+    rows: list
+        One dict per channel with scan, channel, category, mode, unit, xsize, ysize and xres.
+    """
+    with h5py.File(opath, "r") as f:
+        if "index" not in f:
+            return []
+        index = f["index"][()]
+
+    rows = []
+    for row in index:
+        rows.append({key: (value.decode() if isinstance(value, bytes) else value.item() if isinstance(value, np.generic) else value)
+                     for key, value in zip(store_index_dtype.names, row)})
+    return rows
+
+
+def query_store(opath: str, **criteria) -> list:
+    """
+    Returns the index rows of a consolidated store matching all criteria, e.g. query_store(opath, category="LPFM", mode="Forward").
+    """
+    return [row for row in read_store_index(opath) if all(row[key] == value for key, value in criteria.items())]
+
+
+def add_to_store(ipath: str, opath: str, scan: str) -> None:
+    """
+    Copies a converted single-scan hdf5 file into a scan group of a consolidated store, and updates the index.
+
+    Parameters
+    ----------
+    ipath: str
+        path to the single-scan hdf5 file
+    opath: str
+        path to the store, created if it does not exist
+    scan: str
+        name of the scan group, replaced if it exists
+    """
+    with h5py.File(ipath, "r") as src, h5py.File(opath, "a") as dst:
+        if scan in dst:
+            del dst[scan]
+        group = dst.create_group(scan)
+        for key in src:
+            src.copy(src[key], group, name=key)
+        group.attrs.update(src.attrs)
+        update_store_index(dst, scan, store_rows(group))
+    return
+
+
+def block_reduce(data: np.ndarray, factor: int = 2) -> dict:
+    """
+    Reduces blocks of factor x factor pixels to their mean, min and max. Incomplete blocks at the bottom/right edges are dropped.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        A 2D image, or a dict with the mean, min and max of the previous level.
+    factor: int, optional
+        The block size. The default is 2.
+
+    Returns
+    -------
+    level: dict
+        mean, min and max, each of shape (H//factor, W//factor).
+    """
+    levels = data if isinstance(data, dict) else {"mean": data, "min": data, "max": data}
+    h, w = (np.shape(levels["mean"])[0]//factor)*factor, (np.shape(levels["mean"])[1]//factor)*factor
+
+    def blocks(a):
+        return np.asarray(a)[:h, :w].reshape(h//factor, factor, w//factor, factor)
+
+    return {
+        "mean": blocks(levels["mean"]).mean(axis=(1, 3)),
+        "min": blocks(levels["min"]).min(axis=(1, 3)),
+        "max": blocks(levels["max"]).max(axis=(1, 3)),
+    }
+
+
+def build_pyramid(group: h5py.Group, data: np.ndarray, min_size: int = 64, extrema: bool = False, layout: callable = None) -> int:
+    """
+    Writes a downsampled mip-pyramid of a channel to group["pyramid"]: pyramid/<level>/mean, and optionally min and max,
+    where level n is reduced by 2**n in both directions with block means (minima, maxima). 
+    Each level is computed from the previous, so the full resolution data is traversed once. 
+    Levels are halved until the shorter side would be smaller than min_size, and stored as float32.
+
+    Size: the levels hold 1/4 + 1/16 + ... < 1/3 of the pixels of the channel, in float32. 
+    For a float64 channel the means therefore add up to ~17 % to its size, and ~50 % with extrema, before compression.
+
+    Parameters
+    ----------
+    group: h5py.Group
+        The channel group, opened writable.
+    data: np.ndarray
+        The full resolution channel (level 0, which is not duplicated).
+    min_size: int, optional
+        The minimum length of the shorter side of the coarsest level. The default is 64.
+    extrema: bool, optional
+        Whether to also store block minima and maxima. The default is False.
+    layout: callable, optional
+        Returns the create_dataset keyword arguments of a shape, e.g. GwyFile.layout, so the levels are chunked/compressed like the channel. 
+        The default is None (contiguous).
+
+    Returns
+    -------
+    levels: int
+        The number of stored levels.
+    """
+    if "pyramid" in group:
+        del group["pyramid"]
+    pyramid = group.create_group("pyramid")
+    reductions = ["mean", "min", "max"] if extrema else ["mean"]
+
+    level, current = 0, data
+    while min(np.shape(data))//2**(level + 1) >= min_size:
+        level += 1
+        current = block_reduce(current)
+        pyramid.create_group(str(level))
+        for reduction in reductions:
+            values = current[reduction].astype(np.float32)
+            kwargs = {} if layout is None else layout(values.shape)
+            pyramid[str(level)].create_dataset(reduction, data=values, **kwargs)
+        pyramid[str(level)].attrs["factor"] = 2**level
+
+    pyramid.attrs["levels"] = level
+    return level
+
+
+stats_quantiles = np.array([0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999])
+
+
+def channel_stats(data: np.ndarray, bins: int = 100, quantiles: np.ndarray = stats_quantiles) -> dict:
+    """
+    Computes the statistics of a channel used for contrast selection, ignoring non-finite pixels. 
+    Stored as channel attributes at conversion, so they are never recomputed from the pixels.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        The channel.
+    bins: int, optional
+        The number of histogram bins between min and max. The default is 100.
+    quantiles: np.ndarray, optional
+        The quantile levels. The default is stats_quantiles.
+
+    Returns
+    -------
+    stats: dict
+        min, max, mean, std, quantile_levels, quantiles, hist and hist_edges.
+    """
+    values = np.asarray(data).ravel()
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        values = np.zeros(1)
+
+    hist, edges = np.histogram(values, bins=bins)
+    return {
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "quantile_levels": np.asarray(quantiles, dtype=float),
+        "quantiles": np.quantile(values, quantiles),
+        "hist": hist,
+        "hist_edges": edges,
+    }
+
+
+def contrast_limits(stats: dict, method: str = "normal", quantile: float = 0.5) -> tuple:
+    """
+    Returns vmin and vmax for plotting a channel from its stored statistics (see channel_stats).
+
+    Parameters
+    ----------
+    stats: dict
+        The statistics of the channel.
+    method: str, optional
+        "normal": the outermost histogram bins above quantile times the peak count.
+        "binomial": the histogram peaks below and above the mean.
+        "quantile": the pixel quantiles at quantile and 1 - quantile, interpolated between the stored levels.
+        "minmax": the minimum and maximum.
+        The default is "normal".
+    quantile: float, optional
+        The fraction of the peak ("normal") or the quantile level ("quantile"). The default is 0.5.
+
+    Returns
+    -------
+    vmin, vmax: float
+    """
+    hist, edges = np.asarray(stats["hist"]), np.asarray(stats["hist_edges"])
+
+    if method == "normal":
+        above = np.where(hist > np.max(hist)*quantile)[0]
+        return edges[above[0]], edges[above[-1]]
+    elif method == "binomial":
+        below, upper = edges[:-1] < stats["mean"], edges[:-1] > stats["mean"]
+        return edges[:-1][below][np.argmax(hist[below])], edges[:-1][upper][np.argmax(hist[upper])]
+    elif method == "quantile":
+        levels, values = np.asarray(stats["quantile_levels"]), np.asarray(stats["quantiles"])
+        return np.interp(min(quantile, 1 - quantile), levels, values), np.interp(max(quantile, 1 - quantile), levels, values)
+    elif method == "minmax":
+        return stats["min"], stats["max"]
+    raise ValueError(f"Unknown contrast method {method}. Use normal, binomial, quantile or minmax.")
+
+
+def data_hash(data: np.ndarray) -> str:
+    """
+    Returns a hash of the pixels, shape and dtype of a channel, identifying the version of the data processed results are derived from.
+    """
+    data = np.ascontiguousarray(data)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{data.shape}{data.dtype.str}".encode())
+    digest.update(data.data)
+    return digest.hexdigest()
+
+
+def encode_param(value):
+    """
+    JSON encoder for processing parameters. Arrays are represented by their hash, shape and dtype.
+    """
+    if isinstance(value, np.ndarray):
+        return {"ndarray": data_hash(value), "shape": list(value.shape), "dtype": value.dtype.str}
+    if isinstance(value, np.generic):
+        return value.item()
+    return repr(value)
+
+
+def params_key(operation: str, params: dict, source: str) -> str:
+    """
+    Returns the key of a processed result: a hash of the operation name, its parameters and the data hash of the source channel.
+    Equal keys mean the result can be reused.
+    """
+    text = json.dumps({"operation": operation, "params": params, "source": source}, sort_keys=True, default=encode_param)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def pyramid_level(shape: tuple, levels: int, max_pixels: int) -> int:
+    """
+    Returns the finest pyramid level with at most max_pixels pixels, or the coarsest level if none fits.
+    """
+    for level in range(levels + 1):
+        if (shape[0]//2**level)*(shape[1]//2**level) <= max_pixels:
+            return level
+    return levels
+
+
+
+class LazyChannel:
+    """
+    Lazy, read-only view of a channel dataset in a hdf5 file.
+    Only the pixels that are sliced are read from disk. Contiguous and uncompressed datasets are memory mapped directly,
+    while chunked or compressed datasets are read through h5py.
+
+    Attributes
+    ----------
+    opath: str
+        path to the hdf5 file
+    name: str
+        path to the dataset inside the hdf5 file, e.g. "LPFM_Forward_3/data"
+    h5file: callable, optional
+        context manager factory yielding an open h5py.File. The default opens opath read-only on each read.
+    version: callable, optional
+        returns a token that changes whenever the owner writes to the file, e.g. GwyFile.write_count. 
+        Together with the inode, mtime and size of the file, it invalidates the memory map after rewrites.
+    
+    Examples
+    --------
+    >>> crop = gwyfile.get_lazy(3)[100:300, 200:400]
+    """
+
+    def __init__(self, opath: str, name: str, h5file: callable = None, version: callable = None):
+        self.opath = opath
+        self.name = name
+        self.h5file = (lambda: h5py.File(self.opath, "r")) if h5file is None else h5file
+        self.version = version
+        self.map()
+        return
+
+    def signature(self) -> tuple:
+        """
+        Identifies the version of the file on disk (inode, modification time and size) and of the writes of the owner (version), 
+        which must be unchanged for the memory map to be valid.
+        """
+        stat = os.stat(self.opath)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size, None if self.version is None else self.version())
+
+    def map(self) -> None:
+        """
+        Reads shape, dtype and offset of the dataset, and memory maps it if it is contiguous. 
+        Called again whenever the file has been rewritten since (see signature), since the dataset may have moved.
+        """
+        with self.h5file() as f:
+            if f.mode != "r":
+                f.flush()
+            dataset = f[self.name]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            offset = dataset.id.get_offset()
+            contiguous = dataset.chunks is None and dataset.compression is None and self.dtype.kind in "biufc"
+        self._signature = self.signature()
+
+        # Contiguous datasets have a fixed offset in the file, and can be mapped without h5py.
+        if contiguous and offset is not None:
+            self._mmap = np.memmap(self.opath, dtype=self.dtype, mode="r", offset=offset, shape=self.shape)
+        else:
+            self._mmap = None
+        return
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def memory_mapped(self) -> bool:
+        return self._mmap is not None
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """
+        Reads the selected pixels from disk. Supports basic slicing, e.g. [100:300, ::4].
+        """
+        if self._mmap is not None and self.signature() != self._signature:
+            self.map()
+        if self._mmap is not None:
+            return np.array(self._mmap[key])
+        with self.h5file() as f:
+            return f[self.name][key]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __repr__(self) -> str:
+        return f"LazyChannel({self.name}, shape={self.shape}, dtype={self.dtype}, memory_mapped={self.memory_mapped})"
 
 
 
@@ -41,11 +590,11 @@ class GwyFile:
         The key is to use Gwyddion to do an initial filtering of saved scans from experiments. 
         Next, use Gwyddion to export all files containing interesting data to the .gwy-file format.
         Unfortunatly, not all metadata is stored in the .gwy-file, and only reading of the essential metadata is currently implemented. 
-        The .gwy-file is initially read by this class using the gwyfile package.
+        The .gwy-file is initially read by this class with a streaming reader (gwy_io.py), which replaces the gwyfile package.
         CypherFile is a specialized class for .ibw files from the Cypher AFMs. Generally, use this class for Cypher files.
         Note that other essential metadata not recordable or extractable should be manually logged.
 
-        Container for python-processing of data from a gwy-file.
+        Container for python-processing of data from a gwy-file. See GwyBatch for converting a folder of gwy-files.
 
         Attributes
         ----------
@@ -62,22 +611,55 @@ class GwyFile:
                     output path for hdf5 file. If None, the path of the raw data is used.
                 "oname": None,
                     output name for hdf5 file. If None, the name of the raw data is used.
+                "chunks": None,
+                    chunk shape of the channel datasets. If None, 256x256 tiles are used when compressing, otherwise the data is contiguous.
+                "compression": None,
+                    "gzip", "lzf" or "blosc" (requires hdf5plugin). If None, the data is stored uncompressed.
+                "compression_opts": None,
+                    compression level for gzip/blosc.
+                "shuffle": False,
+                    whether to apply the byte shuffle filter before compression.
+                "group": None,
+                    name of the scan group inside a consolidated multi-scan store (see GwyBatch). 
+                    If None, the hdf5 file contains only this scan at its root.
+                "pyramid": None,
+                    minimum side length of the coarsest level of a preview pyramid built at conversion, e.g. 64 (see build_pyramid). 
+                    The pyramid adds ~17 % to the size of the channels (~50 % with pyramid_extrema), stored with the same layout/compression.
+                    If None, no pyramid is built, and previews are read with a stride.
+                "pyramid_extrema": False,
+                    whether the pyramid also stores block minima and maxima.
                 }
         
         Methods
         -------
 
         __call__:
-            Utilises gwy-package to load datafields, 
+            Streams the datafields of the gwy-file, 
             and transfers the data to a hdf5 file with the AFM scan and essential metadata easily accessible.
         get_by_key:
             Returns the data of a channel based on category and mode. 
-            Returns a list if multiple channels are found.
+            Returns a list if multiple channels are found, or optionally lazy views or a stacked array.
+        query:
+            Returns the channel names of a category and/or mode from the in-memory (category, mode) index.
         __getitem__:
             Returns the data of a channel based on its original index, which is the last number in the channel name, 
             and is considered the identification of an individual scan.  
         get_nth:
             Returns the data of the nth channel, meaning the data with index n in self.channel_names.
+        get_lazy:
+            Returns a LazyChannel view of a channel, which only reads the sliced pixels from disk.
+        get_stats:
+            Returns the statistics and histogram of a channel, stored at conversion.
+        save_processed/get_processed/has_processed:
+            Stores, reads and looks up processed results of a channel, keyed by operation, parameters and source data version.
+        compute_processed:
+            Returns a stored processed result, or computes and stores it if not already computed.
+        contrast_limits:
+            Returns vmin and vmax of a channel from its stored histogram or quantiles.
+        get_preview:
+            Returns a downsampled channel from the preview pyramid, at the finest level fitting a pixel count.
+        build_pyramid:
+            Builds the preview pyramids of all channels in an existing hdf5 file.
         get_dataset_keys:
             Returns all dataset keys in a hdf5 file.
         copy_2_other:
@@ -86,6 +668,13 @@ class GwyFile:
             Converts the original index to the index of the channel list.
         index_metadata:
             Returns the metadata of a channel based on index; original index if name is True (default), else based on nth element in channel_names.
+        remove_redundant:
+            Removes all channels except those to keep, optionally compacting the file.
+        compact:
+            Rewrites the hdf5 file to reclaim the space of deleted channels.
+        open/close:
+            Opens/closes a persistent hdf5 handle ("session"), which all reads reuse until closed. 
+            Also usable as a context manager: with GwyFile(path, filename) as gwyfile: ...
         
 
 
@@ -110,6 +699,8 @@ class GwyFile:
             "Backward": ["B:", "Retrace", "Backward", "backward" ]
         }
 
+    matcher = KeyMatcher(keywords, modes)
+
     settings = {
             #TODO: Get more meta data from scan. Current/voltage/frerquency etc. Possibly need for manual logging system.
 
@@ -124,11 +715,25 @@ class GwyFile:
         kwargs = {
             "opath": None
             "oname": None,
+            "chunks": None,
+            "compression": None,
+            "compression_opts": None,
+            "shuffle": False,
+            "group": None,
+            "pyramid": None,
+            "pyramid_extrema": False,
         }
         """
         self.kwargs = {
             "opath": None,
             "oname": None,
+            "chunks": None,
+            "compression": None,
+            "compression_opts": None,
+            "shuffle": False,
+            "group": None,
+            "pyramid": None,
+            "pyramid_extrema": False,
 
         }
 
@@ -145,10 +750,15 @@ class GwyFile:
 
         self.opath = os.path.join(opath, oname + ".hdf5")
 
+        # Session state. The handle is only kept open between open() and close().
+        self._h5 = None
+        self.channel_index = {}
+        self.write_count = 0
+
         try:
 
             with h5py.File(self.opath, "r") as f:
-                self.channel_names = np.array(f["channel_names"], dtype=str) #list(np.array(f["channel_names"], dtype="S")) #TODO: Stored as bytes. Issue?
+                self.channel_names = np.array(self.root(f)["channel_names"], dtype=str) #list(np.array(f["channel_names"], dtype="S")) #TODO: Stored as bytes. Issue?
                 # print(self.channel_names)
             print("H5 Structure exists.")
         except:
@@ -163,73 +773,266 @@ class GwyFile:
     def __call__(self):
         """
         Transforms the gwy-file to a hdf5-file that can be processed and more easily read.
+        The gwy-file is streamed (see gwy_io.GwyStreamReader), and each channel is written as soon as it is parsed,
+        so peak memory is bounded by one channel. 
+        Channels are numbered in the order of their titles, and channels without a title are skipped, as in gwyfile.util.get_datafields.
         """
 
-        obj = gwy.load(self.fullpath)
-        channels = gwy.util.get_datafields(obj)
+        reader = GwyStreamReader(self.fullpath)
 
-        self.channel_names = []
+        channel_names = []
+        channel_index = {}
         print("Channels found: ")
 
-        with h5py.File(self.opath, "w") as f:
-            
-            for id, key in enumerate(channels.keys()):
-                
-                category = str(find_key(GwyFile.keywords, key))
-                mode = str(find_key(GwyFile.modes, key))
+        with self.h5file("w" if self.kwargs["group"] is None else "a") as f:
+
+            if self.kwargs["group"] is None:
+                root = f
+            else:
+                if self.kwargs["group"] in f:
+                    del f[self.kwargs["group"]]
+                root = f.create_group(self.kwargs["group"])
+
+            # The title of a channel usually follows its data, so channels are written to a staging group and moved when all are parsed.
+            staging = root.create_group("_staging")
+            titles = []
+            for kind, number, value in reader:
+
+                if kind == "title":
+                    titles.append((number, value))
+                    continue
+
+                group = staging.create_group(str(number))
+                group.create_dataset("data", data=value["data"], **self.layout(value["data"].shape))
+                group.attrs["unit"] = value["unit"]
+                group.attrs["xsize"] = value["xreal"]
+                group.attrs["ysize"] = value["yreal"]
+                group.attrs["xres"] = value["xreal"] / value["data"].shape[1]
+                group.attrs.update(channel_stats(value["data"]))
+                group.attrs["data_hash"] = data_hash(value["data"])
+                if self.kwargs["pyramid"] is not None:
+                    build_pyramid(group, value["data"], self.kwargs["pyramid"], self.kwargs["pyramid_extrema"], self.layout)
+                del value
+
+            for number, title in titles:
+                if str(number) not in staging:
+                    continue
+
+                id = len(channel_names)
+                category, mode = GwyFile.matcher(title)
+                category, mode = str(category), str(mode)
                 unique = str(id) 
 
                 name = f"{category}_{mode}_{unique}"
-                self.channel_names.append(name)
+                channel_names.append(name)
                 print(name)
-                                
-                f.create_group(name)
-                f[name].create_dataset("data", data=channels[key].data)
-                f[name].attrs["title"] = name
-                f[name].attrs["category"] = category
-                f[name].attrs["mode"] = mode
-                f[name].attrs["unit"] = channels[key].si_unit_z.unitstr
-                f[name].attrs["xsize"] = channels[key].xreal
-                f[name].attrs["ysize"] = channels[key].yreal
-                f[name].attrs["xres"] = channels[key].xreal / channels[key].data.shape[1]
-
-            f.create_dataset("channel_names", data=np.array(self.channel_names, dtype="S") )
+
+                root.move(f"_staging/{number}", name)
+                root[name].attrs["title"] = name
+                root[name].attrs["category"] = category
+                root[name].attrs["mode"] = mode
+                channel_index[name] = {"index": id, "list_index": id, "attrs": dict(root[name].attrs)}
+            del root["_staging"]
+
+            root.create_dataset("channel_names", data=np.array(channel_names, dtype="S") )
+            root.attrs["source_mtime"] = os.stat(self.fullpath).st_mtime
+            root.attrs["source_size"] = os.stat(self.fullpath).st_size
+            if self.kwargs["group"] is not None:
+                update_store_index(f, self.kwargs["group"], store_rows(root))
+
+        self.channel_names = channel_names
+        self.channel_index = channel_index
         return
     
-    def get_by_key(self, key: str) -> list:
+    def is_up_to_date(self) -> bool:
+        """
+        Returns True if the hdf5 file exists and was converted from the current version of the gwy-file.
+        """
+        return is_up_to_date(self.fullpath, self.opath, self.kwargs["group"])
+
+    def root(self, f: h5py.File) -> h5py.Group:
+        """
+        Returns the group containing this scan: the file itself, or the scan group in a consolidated store.
+        """
+        return f if self.kwargs["group"] is None else f[self.kwargs["group"]]
+
+    def layout(self, shape: tuple) -> dict:
+        """
+        Returns the create_dataset keyword arguments of a channel, given the layout kwargs of the instance.
+        """
+        return dataset_layout(shape, self.kwargs["chunks"], self.kwargs["compression"], self.kwargs["compression_opts"], self.kwargs["shuffle"])
+
+    @property
+    def channel_names(self) -> list:
+        """
+        The list of channel names. Setting it rebuilds the lookup from original index to list index.
+        """
+        return self._channel_names
+
+    @channel_names.setter
+    def channel_names(self, names):
+        self._channel_names = [str(name) for name in names]
+        self._list_indices = {int(name.split("_")[-1]): i for i, name in enumerate(self._channel_names)}
+
+        # (category, mode) -> channel names, from the names which are category_mode_index.
+        self.key_index = {}
+        for name in self._channel_names:
+            self.key_index.setdefault(tuple(name.split("_")[:2]), []).append(name)
+        self.channel_index = {name: self.channel_index[name] for name in self._channel_names if name in getattr(self, "channel_index", {})}
+        for i, name in enumerate(self._channel_names):
+            if name in self.channel_index:
+                self.channel_index[name]["list_index"] = i
+
+    def open(self, mode: str = "r"):
+        """
+        Opens a persistent handle to the hdf5 file, and indexes name, original index and attributes of all channels.
+        All reads reuse this handle until close() is called, so repeated reads cost a dataset read instead of a file open.
+
+        Parameters
+        ----------
+        mode: str, optional
+            The h5py file mode of the session. The default is "r".
+
+        Returns
+        -------
+        self: GwyFile
+        """
+        self.close()
+        self._h5 = h5py.File(self.opath, mode)
+        self.build_channel_index(self._h5)
+        return self
+
+    def close(self)->None:
+        """
+        Closes the persistent hdf5 handle, if open.
+        """
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+        return
+
+    def __enter__(self):
+        if self._h5 is None:
+            self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    @contextlib.contextmanager
+    def h5file(self, mode: str = "r"):
+        """
+        Yields the open session handle if possible, otherwise a temporary handle that is closed afterwards.
+        A read-only session is closed during writes and reopened afterwards, since hdf5 does not allow both at once.
+        Every write increments write_count, which invalidates the memory maps of LazyChannel views.
+
+        Parameters
+        ----------
+        mode: str, optional
+            The h5py file mode needed. The default is "r".
+        """
+        if mode != "r":
+            self.write_count += 1
+        try:
+            if self._h5 is None:
+                with h5py.File(self.opath, mode) as f:
+                    yield f
+            elif mode == "r" or (mode in ["r+", "a"] and self._h5.mode == "r+"):
+                yield self._h5
+            else:
+                session_mode = self._h5.mode
+                self.close()
+                try:
+                    with h5py.File(self.opath, mode) as f:
+                        yield f
+                finally:
+                    self.open(session_mode)
+        finally:
+            if mode != "r":
+                self.write_count += 1
+
+    def build_channel_index(self, f: h5py.File)->dict:
+        """
+        Builds the dictionary of channel name to original index, list index and attributes.
+
+        Parameters
+        ----------
+        f: h5py.File
+            An open handle to the hdf5 file.
+
+        Returns
+        -------
+        channel_index: dict
+        """
+        root = self.root(f)
+        self.channel_index = {
+            name: {"index": int(name.split("_")[-1]), "list_index": i, "attrs": dict(root[name].attrs)}
+            for i, name in enumerate(self.channel_names)
+        }
+        return self.channel_index
+
+    def query(self, category: str = None, mode: str = None) -> list:
+        """
+        Returns the names of all channels with the given category and mode, using the in-memory key index.
+        None matches any category/mode, e.g. query("Phase") returns all phase channels.
+
+        Parameters
+        ----------
+        category: str, optional
+            The category, e.g. "LPFM".
+        mode: str, optional
+            The mode, e.g. "Forward".
+
+        Returns
+        -------
+        channels: list
+        """
+        channels = []
+        for (cat, mod), names in self.key_index.items():
+            if (category is None or cat == category) and (mode is None or mod == mode):
+                channels.extend(names)
+        return sorted(channels, key=self.channel_names.index)
+
+    def get_by_key(self, key: str, lazy=False, stack=False):
         """
         Returns the data of a channel based on category and mode. 
         Returns a list if multiple channels are found.
-        Must currently specify both category/keyword and mode.
+        If the key contains no mode, e.g. "Phase", channels of all modes are returned. If the category is not recognized, None is returned.
 
         Parameters
         ----------
         key: str
-            The keyword to search for.
+            The keyword to search for, e.g. "LPFM Forward" or "Phase".
+        lazy: bool, optional
+            If True, LazyChannel views are returned instead of arrays. The default is False.
+        stack: bool, optional
+            If True, the channels are returned as one stacked array of shape (N, H, W). The default is False.
         
         Returns
         -------
-        datas: list
-            A list of the found data.
+        datas: list/np.ndarray
+            A list of the found data, or a stacked array.
         """
-        datas = []
-
         assert len(self.channel_names)>0, "No channels found. Run __call__ first."
 
-        with h5py.File(self.opath, "r") as f:
-
-            for channel in self.channel_names:
-
-                keyword = find_key(GwyFile.keywords, key)
-                mode = find_key(GwyFile.modes, key)
-                if ( re.search( f[channel].attrs["category"], keyword ) is not None) and (re.search(f[channel].attrs["mode"], mode) is not None):
-                    datas.append(np.array(f[channel]["data"]))
+        # Only the mode may be left out, an unknown category finds nothing.
+        keyword = GwyFile.matcher.find(key, verbose=False)
+        mode = GwyFile.matcher.find(key, "modes", verbose=False)
+        channels = [] if keyword is None else self.query(keyword, mode)
 
-        if datas == []:
+        if channels == []:
             print("No data found.")
             return None
-        else:
-            return datas
+
+        if lazy:
+            return [self.get_lazy(channel) for channel in channels]
+
+        with self.h5file() as f:
+            root = self.root(f)
+            datas = [np.array(root[channel]["data"]) for channel in channels]
+
+        return np.stack(datas) if stack else datas
         
 
     def name_index_2_list_index(self, index: int) -> int:
@@ -244,8 +1047,10 @@ class GwyFile:
         int
             The index of the channel in the list of channel names.
         """
-        indices = [int(str(channel).split("_")[-1]) for channel in self.channel_names]
-        return indices.index(index)
+        try:
+            return self._list_indices[index]
+        except KeyError:
+            raise ValueError(f"{index} is not in the list of channels.")
     
     def if_name(self, index:int, name: bool) -> int:
         """
@@ -280,8 +1085,8 @@ class GwyFile:
         index = self.if_name(index, name=True)
         name = self.channel_names[index]
 
-        with h5py.File(self.opath, "r") as f:
-            return np.array(f[name]["data"]) 
+        with self.h5file() as f:
+            return np.array(self.root(f)[name]["data"]) 
     
     def get_nth(self, n: int) -> np.ndarray:
         """
@@ -291,17 +1096,139 @@ class GwyFile:
             The index of the desired channel in the list of channels.
         """
         assert len(self.channel_names) > 0, "No channels found. Run __call__ first."
-        with h5py.File(self.opath, "r") as f:
-            return np.array(f[self.channel_names[n]]["data"])
+        with self.h5file() as f:
+            return np.array(self.root(f)[self.channel_names[n]]["data"])
 
     
+    def get_lazy(self, index: str, name=True) -> LazyChannel:
+        """
+        Returns a lazy view of a channel, which supports slicing straight from disk.
+        Useful for crops and previews of large scans, where only a fraction of the pixels is needed.
+
+        Parameters
+        ----------
+        index: str/int
+            The index of the desired channel.
+        name: bool, optional
+            If True, the index is based on the original names. If False, the index is based on the list of channel names.
+
+        Returns
+        -------
+        LazyChannel
+        """
+        index = self.if_name(index, name=name)
+        group = "" if self.kwargs["group"] is None else self.kwargs["group"] + "/"
+        return LazyChannel(self.opath, f"{group}{self.channel_names[index]}/data", self.h5file, lambda: self.write_count)
+
+    def get_preview(self, index: str, max_pixels: int = 512**2, reduction: str = "mean", name=True) -> tuple:
+        """
+        Returns a downsampled channel for previews, read from the finest pyramid level with at most max_pixels pixels.
+        Without a pyramid (see build_pyramid), or without the requested reduction in it, the channel is read with a stride instead.
+
+        Parameters
+        ----------
+        index: str/int
+            The index of the desired channel.
+        max_pixels: int, optional
+            The target number of pixels. The default is 512**2.
+        reduction: str, optional
+            "mean", "min" or "max" of the blocks. The default is "mean".
+        name: bool, optional
+            If True, the index is based on the original names. If False, the index is based on the list of channel names.
+
+        Returns
+        -------
+        data: np.ndarray
+            The downsampled channel.
+        factor: int
+            The downsampling factor, e.g. for the pixel size xres*factor.
+        """
+        assert reduction in ["mean", "min", "max"], "Reduction must be mean, min or max."
+        index = self.if_name(index, name=name)
+
+        with self.h5file() as f:
+            channel = self.root(f)[self.channel_names[index]]
+            shape = channel["data"].shape
+            levels = int(channel["pyramid"].attrs["levels"]) if "pyramid" in channel else 0
+            if levels > 0 and reduction not in channel["pyramid"]["1"]:
+                levels = 0
+            level = pyramid_level(shape, levels, max_pixels)
+
+            if level > 0:
+                return np.array(channel["pyramid"][str(level)][reduction]), 2**level
+
+            step = max(1, int(np.ceil(np.sqrt(shape[0]*shape[1]/max_pixels))))
+            return channel["data"][::step, ::step], step
+
+    def get_stats(self, index: str, name=True) -> dict:
+        """
+        Returns the statistics of a channel: min, max, mean, std, quantile_levels, quantiles, hist and hist_edges.
+        They are read from the channel attributes written at conversion. 
+        For files converted without them, they are computed from the pixels (see build_stats to store them).
+
+        Parameters
+        ----------
+        index: str/int
+            The index of the desired channel.
+        name: bool, optional
+            If True, the index is based on the original names. If False, the index is based on the list of channel names.
+
+        Returns
+        -------
+        stats: dict
+        """
+        attrs = dict(self.index_metadata(index, name=name))
+        if "hist" not in attrs:
+            index = self.if_name(index, name=name)
+            return channel_stats(self.get_nth(index))
+        return {key: attrs[key] for key in ["min", "max", "mean", "std", "quantile_levels", "quantiles", "hist", "hist_edges"]}
+
+    def contrast_limits(self, index: str, method: str = "normal", quantile: float = 0.5, name=True) -> tuple:
+        """
+        Returns vmin and vmax of a channel from its stored statistics, without reading the pixels. See contrast_limits.
+        """
+        return contrast_limits(self.get_stats(index, name=name), method, quantile)
+
+    def build_stats(self) -> None:
+        """
+        Computes and stores the statistics of all channels in the hdf5 file, e.g. for files converted without them.
+        """
+        assert len(self.channel_names) > 0, "No channels found. Run __call__ first."
+        with self.h5file("r+") as f:
+            root = self.root(f)
+            for channel in self.channel_names:
+                root[channel].attrs.update(channel_stats(np.array(root[channel]["data"])))
+                if channel in self.channel_index:
+                    self.channel_index[channel]["attrs"] = dict(root[channel].attrs)
+        return
+
+    def build_pyramid(self, min_size: int = 64, extrema: bool = False) -> None:
+        """
+        Builds the preview pyramids of all channels in the hdf5 file, e.g. for files converted without one.
+        The levels are stored with the layout/compression kwargs of the instance, and add ~17 % to the size of the channels (~50 % with extrema).
+
+        Parameters
+        ----------
+        min_size: int, optional
+            The minimum length of the shorter side of the coarsest level. The default is 64.
+        extrema: bool, optional
+            Whether to also store block minima and maxima. The default is False.
+        """
+        assert len(self.channel_names) > 0, "No channels found. Run __call__ first."
+        with self.h5file("r+") as f:
+            root = self.root(f)
+            for channel in self.channel_names:
+                build_pyramid(root[channel], np.array(root[channel]["data"]), min_size, extrema, self.layout)
+        return
+
     def get_dataset_keys(self):
         """
         Returns all dataset keys in a hdf5 file.
         """
         keys = []
-        with h5py.File(self.opath, "r") as f:
-            f.visit(lambda key: keys.append(key) if isinstance(f[key], h5py.Dataset) else None)
+        with self.h5file() as f:
+            root = self.root(f)
+            root.visit(lambda key: keys.append(key) if isinstance(root[key], h5py.Dataset) else None)
         return keys
     
 
@@ -309,6 +1236,7 @@ class GwyFile:
         """
 
         Copies all channels to keep to a new hdf5 file.
+        The channel groups are copied in bulk at hdf5-level, including attributes, processed data and storage layout.
 
 
         Parameters
@@ -350,21 +1278,16 @@ class GwyFile:
 
         keep = [self.channel_names[index] for index in keep]
 
-        # Copies the channels to the new file, and initializes a new instance. 
-        with h5py.File(new_opath, "w") as f:
+        # Copies the channel groups (data, attributes and processed results) to the new file at hdf5-level through one source handle,
+        # without decoding into numpy, and initializes a new instance. 
+        with self.h5file() as src, h5py.File(new_opath, "w") as f:
+            root = self.root(src)
 
             for channel in keep:
-                f.create_group(channel)
-                f[channel].create_dataset("data", data=self[channel])
-                f[channel].attrs["title"] = str(channel)
-                f[channel].attrs["category"] = channel.split("_")[0]
-                f[channel].attrs["mode"] = channel.split("_")[1]
-                f[channel].attrs["unit"] =  self.index_metadata(index= channel, feature= "unit", name=True )
-                f[channel].attrs["xsize"] = self.index_metadata(index=channel, feature="xsize", name=True) 
-                f[channel].attrs["ysize"] = self.index_metadata(index=channel, feature="ysize", name=True) 
-                f[channel].attrs["xres"]  = self.index_metadata(index=channel, feature="xres", name=True)  
+                root.copy(root[channel], f, name=channel)
             
             f.create_dataset("channel_names", data=np.array(keep, dtype="S") )
+            f.attrs.update(root.attrs)
 
         other = GwyFile(path=self.path, filename=self.filename, opath=new_path, oname=new_name)
         other.channel_names = keep
@@ -391,24 +1314,30 @@ class GwyFile:
 
         ch_name = self.channel_names[index]
 
-        #Returns either all items, or a single feature. 
+        #Returns either all items, or a single feature. Uses the channel index of a session if available.
+        if ch_name in self.channel_index:
+            attrs = self.channel_index[ch_name]["attrs"]
+        else:
+            with self.h5file() as f:
+                attrs = dict(self.root(f)[ch_name].attrs)
+
         if feature is None:
-            with h5py.File(self.opath, "r") as f:
-                return f[ch_name].attrs.items()
+            return attrs.items()
         else:
-            with h5py.File(self.opath, "r") as f:
-                return f[ch_name].attrs[feature]
+            return attrs[feature]
     
-    def remove_redundant(self, keep: list, name=True):
+    def remove_redundant(self, keep: list, name=True, compact=False):
         """
         Removes all channels except those in the keep list.
         Keep list with name=True means that the number included refers to the originally assigned index, and/or that a whole name is written. 
-        Note that the original file size is not reduced, but the removed channels are deleted, and the channel_names list is updated.
+        Note that the original file size is not reduced unless compact is True, but the removed channels are deleted, and the channel_names list is updated.
 
         keep: list
             The list of channels to keep. Either indices (original or current), or entire channel names.
         name: bool, optional
             If True, the indices are based on the original names. If False, the indices are based on the list of channel names.
+        compact: bool, optional
+            If True, the file is rewritten afterwards to reclaim the space of the removed channels (see compact). The default is False.
 
         Returns
         -------
@@ -424,15 +1353,52 @@ class GwyFile:
         
         keep = [self.channel_names[index] for index in keep] 
         
-        with h5py.File(self.opath, "r+") as f:
+        with self.h5file("r+") as f:
+            root = self.root(f)
             for channel in self.channel_names:
                 if channel not in keep:
-                    del f[channel]
-            del f["channel_names"]
-            f.create_dataset("channel_names", data=np.array(keep, dtype="S") )
+                    del root[channel]
+            del root["channel_names"]
+            root.create_dataset("channel_names", data=np.array(keep, dtype="S") )
             self.channel_names = keep
+            if self.kwargs["group"] is not None:
+                update_store_index(f, self.kwargs["group"], store_rows(root))
 
+        if compact:
+            self.compact()
         return
+
+    def compact(self) -> int:
+        """
+        Rewrites the hdf5 file to reclaim the free space left by deleted channels or datasets.
+        All groups, datasets (including processed data) and attributes are copied with their layout to a fresh file, 
+        which then atomically replaces the original. For a consolidated store, the entire store is compacted.
+
+        Returns
+        -------
+        reclaimed: int
+            The number of bytes reclaimed.
+        """
+        session_mode = None if self._h5 is None else self._h5.mode
+        self.close()
+
+        before = os.path.getsize(self.opath)
+        tmp_path = self.opath + ".compact.tmp"
+        try:
+            with h5py.File(self.opath, "r") as src, h5py.File(tmp_path, "w") as dst:
+                for key in src:
+                    src.copy(src[key], dst, name=key)
+                dst.attrs.update(src.attrs)
+            os.replace(tmp_path, self.opath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if session_mode is not None:
+                self.open(session_mode)
+
+        reclaimed = before - os.path.getsize(self.opath)
+        print(f"Compacted {os.path.basename(self.opath)}: {reclaimed} bytes reclaimed.")
+        return reclaimed
     
     def copy_n_remove(self, new_name: str, keep: list, name=True, **kwargs):
         """
@@ -461,6 +1427,15 @@ class GwyFile:
         assert os.path.exists(self.opath), "Original file not found."
 
         new = self.copy_2_other(new_name, keep, name, **kwargs)
+
+        # In a consolidated store, only the scan group is removed.
+        if self.kwargs["group"] is not None:
+            with self.h5file("r+") as f:
+                del f[self.kwargs["group"]]
+                update_store_index(f, self.kwargs["group"], [])
+            return new
+
+        self.close()
         with h5py.File(self.opath, "r+") as f:
             del f
         try:
@@ -471,7 +1446,7 @@ class GwyFile:
             return new
     
 
-    def create_overview_file(self, quantile: float = 0.69)->None:
+    def create_overview_file(self, quantile: float = 0.69, max_size: int = 1024)->None:
         """
         Creates an overview file of the channels in the hdf5 file.
         The overview file is saved in the same folder as the hdf5 file.
@@ -481,33 +1456,25 @@ class GwyFile:
         ----------
         quantile: float, optional
             The quantile of the histogram to use for the colorbar. The default is 0.69.
-            The higher the quantile, the more saturated the colors will be.
+            The higher the quantile, the more saturated the colors will be. The stored histogram of each channel is used (see get_stats).
+        max_size: int, optional
+            The approximate number of pixels along each axis in the overview. Larger channels are read from the preview pyramid (see get_preview). The default is 1024.
         
         Returns
         -------
         None
         """
 
+        import matplotlib.pyplot as plt
+
         fig, axes = plt.subplots(1, len(self.channel_names), figsize=(len(self.channel_names)*5, 5))
 
-        for ax, channel in zip(axes.reshape(-1), self.channel_names):
+        for ax, channel in zip(np.atleast_1d(axes).reshape(-1), self.channel_names):
             ind = int(channel.split("_")[-1])
-            data = self[ind]
+            data, factor = self.get_preview(ind, max_pixels=max_size**2)
 
             #TODO: Consider using kde instead to automatically account for data size via Scott's rule. 
-            hist, edges = np.histogram(data, bins=100)
-
-            # Find peak value
-            pvalue = np.max(hist)
-            peak = edges[np.argmax(hist)]
-
-            # Find lower and upper bounds
-            lower = edges[np.where(hist > pvalue*quantile)[0][0]]
-            upper = edges[np.where(hist > pvalue*quantile)[0][-1]]
-
-            vmin = lower
-            vmax = upper
-
+            vmin, vmax = self.contrast_limits(ind, "normal", quantile)
 
             ax.imshow(data, cmap="magma", vmin=vmin, vmax=vmax)
             ax.set_title(channel)
@@ -518,9 +1485,28 @@ class GwyFile:
         plt.show()
         return
     
-    def save_processed(self, index:str, data:np.ndarray, name=True)->None:
+    def data_hash(self, index: str, name=True) -> str:
+        """
+        Returns the hash of the pixels of a channel (see data_hash), stored at conversion or computed for older files.
+        """
+        attrs = dict(self.index_metadata(index, name=name))
+        if "data_hash" in attrs:
+            return str(attrs["data_hash"])
+        return data_hash(self.get_nth(self.if_name(index, name=name)))
+
+    def processed_key(self, index: str, operation: str, params: dict = None, name=True) -> str:
+        """
+        Returns the key of a processed result of a channel, from the operation, its parameters and the version of the channel data.
         """
-        Saves processed data to the hdf5 file.
+        return params_key(operation, {} if params is None else params, self.data_hash(index, name=name))
+
+    def save_processed(self, index:str, data:np.ndarray, name=True, operation: str = "processed", params: dict = None, mode: str = "overwrite")->str:
+        """
+        Saves processed data of a channel to the hdf5 file, as results/<operation>/<key>/<version> in the channel group.
+        The key is a hash of the operation, the parameters and the data hash of the channel (see processed_key), 
+        so results are invalidated when the parameters or the source data change.
+        The operation, parameters, source channel, source data hash, version and time are stored as attributes.
+        Overwriting the default operation without parameters also removes the legacy "processed" dataset of older files.
 
         Parameters
         ----------
@@ -530,20 +1516,300 @@ class GwyFile:
             The processed data to save.
         name: bool, optional
             If True, the index is based on the original names. If False, the index is based on the list of channel names.
+        operation: str, optional
+            The name of the operation, e.g. "level". The default is "processed".
+        params: dict, optional
+            The parameters of the operation. The default is None (no parameters).
+        mode: str, optional
+            "overwrite" replaces all versions of the result, "append" adds a new version. The default is "overwrite".
 
         Returns
         -------
-        None
+        key: str
+            The key of the result.
         """
-        if name:
-            # index = int(str(index).split("_")[-1])
-            # index = self.name_index_2_list_index(index)
-            index = self.if_name(index, name=name)
+        assert mode in ["overwrite", "append"], "Mode must be overwrite or append."
+        params = {} if params is None else params
+        source = self.data_hash(index, name=name)
+        key = params_key(operation, params, source)
+
+        index = self.if_name(index, name=name)
         channel = self.channel_names[index]
 
-        with h5py.File(self.opath, "r+") as f:
-            f[channel].create_dataset("processed", data=data)
-            #TODO: Add more metadata?
-        return
+        with self.h5file("r+") as f:
+            results = self.root(f)[channel].require_group("results").require_group(operation)
+            if mode == "overwrite" and key in results:
+                del results[key]
+            if mode == "overwrite" and self.legacy_processed(self.root(f)[channel], operation, params) is not None:
+                del self.root(f)[channel]["processed"]
+            result = results.require_group(key)
+
+            version = len(result)
+            group = result.create_group(str(version))
+            group.create_dataset("data", data=data, **(self.layout(np.shape(data)) if np.ndim(data) > 0 else {}))
+            group.attrs["operation"] = operation
+            group.attrs["params"] = json.dumps(params, sort_keys=True, default=encode_param)
+            group.attrs["source"] = channel
+            group.attrs["data_hash"] = source
+            group.attrs["version"] = version
+            group.attrs["created"] = time.time()
+        return key
+
+    @staticmethod
+    def legacy_processed(channel: h5py.Group, operation: str, params: dict) -> h5py.Dataset:
+        """
+        Returns the "processed" dataset written by save_processed in older versions, which had no operation or parameters, 
+        if it exists and the default operation without parameters is asked for. Otherwise None.
+        """
+        if operation == "processed" and not params and isinstance(channel.get("processed"), h5py.Dataset):
+            return channel["processed"]
+        return None
+
+    def has_processed(self, index: str, operation: str = "processed", params: dict = None, name=True) -> bool:
+        """
+        Returns True if the result of the operation with these parameters is stored for the current data of the channel.
+        """
+        key = self.processed_key(index, operation, params, name=name)
+        channel = self.channel_names[self.if_name(index, name=name)]
+        with self.h5file() as f:
+            root = self.root(f)
+            return f"{channel}/results/{operation}/{key}" in root or self.legacy_processed(root[channel], operation, params) is not None
+
+    def get_processed(self, index: str, operation: str = "processed", params: dict = None, version: int = -1, name=True) -> np.ndarray:
+        """
+        Returns a stored processed result of a channel, or None if it is not computed for the current data and parameters.
+        The legacy "processed" dataset of older files is returned for the default operation without parameters.
+
+        Parameters
+        ----------
+        index: str
+            The index of the channel.
+        operation: str, optional
+            The name of the operation. The default is "processed".
+        params: dict, optional
+            The parameters of the operation. The default is None (no parameters).
+        version: int, optional
+            The version, counted as a list index among the appended versions. The default is -1, the latest.
+        name: bool, optional
+            If True, the index is based on the original names. If False, the index is based on the list of channel names.
+
+        Returns
+        -------
+        data: np.ndarray
+        """
+        key = self.processed_key(index, operation, params, name=name)
+        channel = self.channel_names[self.if_name(index, name=name)]
+        with self.h5file() as f:
+            path = f"{channel}/results/{operation}/{key}"
+            if path not in self.root(f):
+                legacy = self.legacy_processed(self.root(f)[channel], operation, params)
+                return None if legacy is None else np.array(legacy)
+            result = self.root(f)[path]
+            versions = sorted(result, key=int)
+            return np.array(result[versions[version]]["data"])
+
+    def compute_processed(self, index: str, operation: str, function: callable, params: dict = None, force=False, name=True) -> np.ndarray:
+        """
+        Returns the stored result of function(data, **params) for a channel, and only computes and stores it if it is not already computed.
+        Reruns of expensive leveling or filtering steps are thereby skipped.
+
+        Parameters
+        ----------
+        index: str
+            The index of the channel.
+        operation: str
+            The name of the operation, part of the result key.
+        function: callable
+            Called as function(data, **params) with the channel data.
+        params: dict, optional
+            The keyword arguments of function. The default is None (no parameters).
+        force: bool, optional
+            If True, the result is recomputed and overwritten. The default is False.
+        name: bool, optional
+            If True, the index is based on the original names. If False, the index is based on the list of channel names.
+
+        Returns
+        -------
+        data: np.ndarray
+        """
+        params = {} if params is None else params
+        if not force:
+            result = self.get_processed(index, operation, params, name=name)
+            if result is not None:
+                return result
+
+        result = function(self.get_nth(self.if_name(index, name=name)), **params)
+        self.save_processed(index, result, name=name, operation=operation, params=params, mode="overwrite")
+        return result
             
 
+
+
+
+def timed_call(filename: str, function: callable, *args, **kwargs) -> tuple:
+    """
+    Calls function(*args, **kwargs) and catches any exception, so one failing file does not abort a batch. 
+    Shared by the worker functions of GwyBatch and CypherBatch.
+
+    Returns
+    -------
+    tuple
+        filename, seconds spent and the error message (None if successful).
+    """
+    start = time.perf_counter()
+    try:
+        function(*args, **kwargs)
+        return filename, time.perf_counter() - start, None
+    except Exception as error:
+        return filename, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+
+
+def report_entry(filename: str, seconds: float, error: str = None, status: str = None) -> dict:
+    """
+    Returns a report entry of a batch. The status is "converted" or "failed" from the error, unless given (e.g. "skipped").
+    """
+    status = ("converted" if error is None else "failed") if status is None else status
+    return {"filename": filename, "status": status, "seconds": seconds, "error": error}
+
+
+def print_report(report: list) -> None:
+    """
+    Sorts the report of a batch by filename in place, and prints one line per file and a summary.
+    """
+    report.sort(key=lambda entry: entry["filename"])
+    for entry in report:
+        line = f"{entry['filename']}: {entry['status']} ({entry['seconds']:.2f} s)"
+        print(line if entry["error"] is None else line + f" {entry['error']}")
+
+    counts = {status: sum(entry["status"] == status for entry in report) for status in ["converted", "skipped", "failed"]}
+    print(f"Converted {counts['converted']}, skipped {counts['skipped']}, failed {counts['failed']}.")
+    return
+
+
+def convert_gwy(path: str, filename: str, kwargs: dict) -> tuple:
+    """
+    Converts a single gwy-file with GwyFile.__call__. Worker function of GwyBatch.
+
+    Returns
+    -------
+    tuple
+        filename, seconds spent and the error message (None if successful), see timed_call.
+    """
+    return timed_call(filename, lambda: GwyFile(path, filename, **kwargs)())
+
+
+class GwyBatch:
+    """
+    Converts all gwy-files in a folder to hdf5-files with GwyFile.__call__, in parallel worker processes.
+    Files with an up-to-date hdf5-file (same modification time and size of the gwy-file as when converted) are skipped.
+    A failing file is reported, but does not abort the batch.
+
+    Attributes
+    ----------
+    path: str
+        path to folder containing the gwy-files
+    **kwargs: dict, optional
+        The default is:
+
+            {
+            "pattern": "*.gwy",
+                glob pattern of the files to convert.
+            "workers": None,
+                number of worker processes. None uses the number of processors, 1 converts in this process.
+            "force": False,
+                convert all files, also those that are up to date.
+            "store": None,
+                name of a consolidated store. If given, all scans are collected in one hdf5 file with one group per scan,
+                and a top-level "index" table (see read_store_index and query_store). Access a scan with 
+                GwyFile(path, filename, oname=store, group=filename).
+            }
+
+        Other kwargs (opath, chunks, compression, compression_opts, shuffle, pyramid) are passed on to GwyFile.
+
+    Methods
+    -------
+    __call__:
+        Converts the files and returns the report.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        self.kwargs = {
+            "pattern": "*.gwy",
+            "workers": None,
+            "force": False,
+            "store": None,
+        }
+        self.file_kwargs = {}
+
+        for key, value in kwargs.items():
+            if key in self.kwargs:
+                self.kwargs[key] = value
+            elif key not in ["oname", "group"]:
+                self.file_kwargs[key] = value
+
+        self.path = path
+        self.filenames = sorted(os.path.basename(file)[:-4] for file in glob(os.path.join(self.path, self.kwargs["pattern"])) if file.endswith(".gwy"))
+        self.report = []
+        print(f"{len(self.filenames)} gwy-files found.")
+        return
+
+    def opath(self, filename: str) -> str:
+        """
+        Returns the output path of the hdf5 file of a scan, which is the store if used.
+        """
+        opath = self.path if self.file_kwargs.get("opath") is None else self.file_kwargs["opath"]
+        oname = filename if self.kwargs["store"] is None else self.kwargs["store"]
+        return os.path.join(opath, oname + ".hdf5")
+
+    def __call__(self) -> list:
+        """
+        Converts the gwy-files and prints a summary.
+
+        Returns
+        -------
+        report: list
+            One dict per file with filename, status ("converted", "skipped" or "failed"), seconds and error.
+        """
+        self.report = []
+        todo = []
+        for filename in self.filenames:
+            group = None if self.kwargs["store"] is None else filename
+            if not self.kwargs["force"] and is_up_to_date(os.path.join(self.path, filename + ".gwy"), self.opath(filename), group):
+                self.report.append(report_entry(filename, 0.0, status="skipped"))
+            else:
+                todo.append(filename)
+
+        # With a store, workers convert to temporary files which are merged one by one, since hdf5 files cannot be written in parallel.
+        file_kwargs = dict(self.file_kwargs)
+        tmpdir = None
+        if self.kwargs["store"] is not None:
+            tmpdir = tempfile.mkdtemp(dir=os.path.dirname(self.opath("")))
+            file_kwargs["opath"] = tmpdir
+
+        results = []
+        try:
+            if self.kwargs["workers"] == 1:
+                results = [convert_gwy(self.path, filename, file_kwargs) for filename in todo]
+            else:
+                with ProcessPoolExecutor(max_workers=self.kwargs["workers"]) as executor:
+                    futures = [executor.submit(convert_gwy, self.path, filename, file_kwargs) for filename in todo]
+                    results = [future.result() for future in as_completed(futures)]
+
+            if tmpdir is not None:
+                for i, (filename, seconds, error) in enumerate(results):
+                    if error is None:
+                        start = time.perf_counter()
+                        try:
+                            add_to_store(os.path.join(tmpdir, filename + ".hdf5"), self.opath(filename), filename)
+                        except Exception as merge_error:
+                            error = f"{type(merge_error).__name__}: {merge_error}"
+                        results[i] = (filename, seconds + time.perf_counter() - start, error)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        for filename, seconds, error in results:
+            self.report.append(report_entry(filename, seconds, error))
+
+        print_report(self.report)
+        return self.report